@@ -0,0 +1,488 @@
+"""
+
+Benchmarks for the calendar hot paths
+
+Generates a synthetic calendar -- organizations, categories, events
+with a mix of one-day, irregular and recurring schedules -- and times
+the code that serves it. Run it with the instance's Python so Zope and
+the site are available:
+
+    bin/instance run src/dcn.eventreader/dcn/eventreader/benchmark.py \\
+        --site=Plone --load --output=before.json
+
+--load replaces the contents of Orgs, GlobalCategories, Events,
+EvDates and EvCats in the database behind the site's write provider,
+and rebuilds EvOccurrences from them, so point dbCal and dbCalWriter
+at a scratch database first, or use the SQLite stand-in
+(browser/sqlite-overrides.zcml). Without --site only the pure Python
+benchmarks (recurrence expansion, row records, date representations)
+run. Results are written as JSON;
+--compare=before.json reports the change against an earlier run.
+
+"""
+
+import gc
+import json
+import optparse
+import platform
+import random
+import sys
+from datetime import date, time, timedelta
+from time import time as now
+
+from dcn.eventreader.browser import caldate
+from dcn.eventreader.browser import records
+from dcn.eventreader.browser.directory import Record
+
+
+# share of events with each kind of schedule; 'irregular' events
+# have several one-day EvDates rows, 'once' events a single one
+recurrence_mix = {
+    'once': 0.55,
+    'irregular': 0.10,
+    'daily': 0.05,
+    'weekly': 0.20,
+    'biweekly': 0.05,
+    'monthly': 0.05,
+    }
+
+# share of events without start and end times
+all_day_share = 0.15
+
+# (name, params) for the view benchmarks
+view_modes = (
+    ('month', {}),
+    ('week', {'mode': 'week'}),
+    ('day', {'mode': 'day'}),
+    ('upcoming', {'mode': 'upcoming', 'days': '30'}),
+    )
+
+
+def generate(orgs=20, events_per_org=100, cats_per_org=6,
+        cats_per_event=2, spread=365, mix=None, start=None, seed=1):
+    """
+        Synthetic table rows as a dict of table name -> list of
+        row dicts. Event dates fall within spread days either side
+        of start (default today); seed makes the data repeatable.
+    """
+
+    rnd = random.Random(seed)
+    start = start or date.today()
+    mix = sorted((mix or recurrence_mix).items())
+    total = float(sum([share for kind, share in mix]))
+
+    def schedule():
+        pick = rnd.random() * total
+        for kind, share in mix:
+            pick -= share
+            if pick < 0:
+                return kind
+        return mix[-1][0]
+
+    tables = {
+        'Orgs': [],
+        'GlobalCategories': [],
+        'Events': [],
+        'EvDates': [],
+        'EvCats': [],
+        }
+    gcid = eid = 0
+    for oid in range(1, orgs + 1):
+        tables['Orgs'].append({
+            'oid': oid,
+            'name': 'Organization %i' % oid,
+            'acronym': 'ORG%i' % oid,
+            'url': 'http://org%i.example.org/' % oid,
+            'description': 'Synthetic organization %i' % oid,
+            })
+        gcids = []
+        for i in range(cats_per_org):
+            gcid += 1
+            gcids.append(gcid)
+            tables['GlobalCategories'].append({
+                'gcid': gcid,
+                'title': 'Category %i' % gcid,
+                'oid': oid,
+                })
+        for i in range(events_per_org):
+            eid += 1
+            if rnd.random() < all_day_share:
+                begins = ends = time(0, 0)
+            else:
+                begins = time(rnd.randint(7, 20), rnd.choice((0, 15, 30, 45)))
+                ends = time(min(begins.hour + rnd.randint(1, 3), 23), begins.minute)
+            tables['Events'].append({
+                'eid': eid,
+                'oid': oid,
+                'startTime': begins,
+                'endTime': ends,
+                'title': 'Event %i of organization %i' % (i + 1, oid),
+                'description': 'Synthetic event %i' % eid,
+                'location': 'Room %i' % rnd.randint(1, 50),
+                'eventUrl': '',
+                'public': rnd.choice('yyyn'),
+                'free': rnd.choice('yn'),
+                'community': rnd.choice('yyn'),
+                'udf1': rnd.choice('yn'),
+                'udf2': rnd.choice('yn'),
+                'lastUpdator': 'benchmark',
+                })
+            first = start + timedelta(rnd.randint(-spread, spread))
+            kind = schedule()
+            if kind == 'once':
+                dates = [(first, first, 'daily')]
+            elif kind == 'irregular':
+                dates = []
+                day = first
+                for j in range(rnd.randint(2, 6)):
+                    dates.append((day, day, 'daily'))
+                    day += timedelta(rnd.randint(1, 14))
+            else:
+                last = first + timedelta(rnd.randint(7, 180))
+                dates = [(first, last, kind)]
+            for sdate, edate, recurs in dates:
+                tables['EvDates'].append({
+                    'eid': eid,
+                    'sdate': sdate,
+                    'edate': edate,
+                    'recurs': recurs,
+                    })
+            for cid in rnd.sample(gcids, min(cats_per_event, len(gcids))):
+                tables['EvCats'].append({'eid': eid, 'gcid': cid})
+    return tables
+
+
+def sqlValue(val):
+    """ SQL literal for a generated value """
+
+    if val is None:
+        return 'NULL'
+    if isinstance(val, (int, long)):
+        return str(val)
+    if isinstance(val, (date, time)):
+        return "'%s'" % val.isoformat()
+    return "'%s'" % str(val).replace('\\', '\\\\').replace("'", "''")
+
+
+def insertStatements(tables, batch=500):
+    """ INSERT statements for generated tables, batch rows apiece """
+
+    for name in ('Orgs', 'GlobalCategories', 'Events', 'EvDates', 'EvCats'):
+        rows = tables[name]
+        if not rows:
+            continue
+        columns = sorted(rows[0])
+        for i in range(0, len(rows), batch):
+            values = [
+                "(%s)" % ', '.join([sqlValue(row[c]) for c in columns])
+                for row in rows[i:i + batch]
+                ]
+            yield "INSERT INTO %s (%s) VALUES\n%s" % (
+                name, ', '.join(columns), ',\n'.join(values))
+
+
+def loadTables(query, tables):
+    """
+        Replace the calendar tables' contents with tables, and
+        empty EvOccurrences; query is a callable that executes one
+        SQL statement. Call rebuildOccurrences afterwards.
+    """
+
+    from dcn.eventreader.browser.dbaccess import occurrences_ddl
+
+    for name in ('EvCats', 'EvDates', 'Events', 'GlobalCategories', 'Orgs'):
+        query("DELETE FROM %s" % name)
+    # occurrences of the old events would attach to the new ones,
+    # which reuse their eids; the caller rebuilds the table
+    query(occurrences_ddl)
+    query("DELETE FROM EvOccurrences")
+    for statement in insertStatements(tables):
+        query(statement)
+
+
+def timeCall(func, repeat=5, number=1, setup=None):
+    """
+        Time func, number calls per sample, over repeat samples,
+        calling setup (untimed) before each call. Returns per-call
+        statistics in milliseconds.
+    """
+
+    samples = []
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for i in range(repeat):
+            elapsed = 0.0
+            for j in range(number):
+                if setup is not None:
+                    setup()
+                began = now()
+                func()
+                elapsed += now() - began
+            samples.append(elapsed * 1000.0 / number)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    samples.sort()
+    return {
+        'min': round(samples[0], 4),
+        'median': round(samples[len(samples) // 2], 4),
+        'mean': round(sum(samples) / len(samples), 4),
+        'max': round(samples[-1], 4),
+        'repeat': repeat,
+        'number': number,
+        }
+
+
+class Runner(object):
+    """ runs benchmarks and collects their results by name """
+
+    def __init__(self, repeat=5, verbose=True):
+        self.repeat = repeat
+        self.verbose = verbose
+        self.results = {}
+
+    def run(self, name, func, number=1, setup=None):
+        result = timeCall(func, self.repeat, number, setup)
+        self.results[name] = result
+        if self.verbose:
+            print >> sys.stderr, "%-40s %10.3f ms" % (name, result['median'])
+        return result
+
+
+def rangeResult(tables, start, end):
+    """
+        An (items, rows) result like the database adapter's for
+        eventsByDateRange over start to end
+    """
+
+    names = ('eid', 'title', 'description', 'startTime', 'endTime',
+        'location', 'eventUrl', 'acronym', 'orgname', 'url',
+        'start', 'end', 'recurs')
+    events = dict([(e['eid'], e) for e in tables['Events']])
+    orgs = dict([(o['oid'], o) for o in tables['Orgs']])
+    rows = []
+    for ev in tables['EvDates']:
+        if ev['sdate'] > end or ev['edate'] < start:
+            continue
+        e = events[ev['eid']]
+        o = orgs[e['oid']]
+        rows.append((
+            e['eid'], e['title'], e['description'],
+            e['startTime'].hour * 3600 + e['startTime'].minute * 60,
+            e['endTime'].hour * 3600 + e['endTime'].minute * 60,
+            e['location'], e['eventUrl'], o['acronym'], o['name'], o['url'],
+            ev['sdate'].toordinal(),
+            ev['edate'].toordinal(),
+            ev['recurs'],
+            ))
+    rows.sort(key=lambda r: (r[10], r[3], r[1]))
+    return [{'name': name} for name in names], rows
+
+
+def pureBenchmarks(runner, tables, target):
+    """ benchmarks that need no database or site """
+
+    from dcn.eventreader.browser.eventview import getEventDateRep
+
+    month = (caldate.startOfMonth(target), caldate.endOfMonth(target))
+    year = (target, target + timedelta(365))
+    rows = [(ev['sdate'], ev['edate'], ev['recurs']) for ev in tables['EvDates']]
+
+    runner.run('caldate.expandRows month',
+        lambda: caldate.expandRows(rows, *month))
+    runner.run('caldate.expandRows year',
+        lambda: caldate.expandRows(rows, *year))
+    runner.run('caldate.expand each row',
+        lambda: [caldate.expand(s, e, s, r) for s, e, r in rows])
+
+    result = rangeResult(tables, *month)
+
+    def readAll():
+        for rec in records.makeRecords(result):
+            rec['title'], rec['start'], rec['begins'], rec['ends']
+
+    runner.run('records.makeRecords month', lambda: records.makeRecords(result))
+    runner.run('records read month', readAll)
+
+    by_eid = {}
+    for ev in tables['EvDates']:
+        by_eid.setdefault(ev['eid'], []).append(Record(
+            start=ev['sdate'], end=ev['edate'], recurs=ev['recurs']))
+    schedules = by_eid.values()
+    runner.run('getEventDateRep all events',
+        lambda: [getEventDateRep(dates) for dates in schedules])
+
+
+def makeView(site, name, form):
+    """ a fresh view with a fresh request, so nothing is memoized """
+
+    from zope.component import getMultiAdapter
+    from dcn.eventreader.browser.dbaccess import clearRequestCache
+
+    request = site.REQUEST
+    request.form.clear()
+    request.form.update(form)
+    clearRequestCache(request)
+    view = getMultiAdapter((site, request), name=name)
+    view.__name__ = name
+    return view
+
+
+def siteBenchmarks(runner, site, tables, target, warm=False):
+    """ benchmarks of the database provider and views on site """
+
+    from dcn.eventreader.browser import cache
+    from dcn.eventreader.browser.dbaccess import IEventDatabaseProvider
+
+    reset = not warm and cache.clearAll or None
+    oids = [o['oid'] for o in tables['Orgs']]
+    month = (caldate.startOfMonth(target), caldate.endOfMonth(target))
+    day = target.isoformat()
+
+    def provider():
+        db = IEventDatabaseProvider(site)
+        return db.eventsByDateRange(month[0], month[1], oids)
+
+    runner.run('eventsByDateRange month', provider, setup=reset)
+
+    for mode, form in view_modes:
+        form = dict(form, date=day)
+
+        def byDay():
+            view = makeView(site, 'calendar', form)
+            return view.eventsByDay(*view.dateRange())
+
+        runner.run('eventsByDay %s' % mode, byDay, setup=reset)
+
+    def urls():
+        view = makeView(site, 'calendar', {'date': day})
+        for oid in oids:
+            view.getCats(oid=oid)
+        for i in range(100):
+            view.myUrl(mode='week', date=target + timedelta(i))
+
+    runner.run('getCats and myUrl', urls, setup=reset)
+
+    for mode, form in view_modes:
+        form = dict(form, date=day)
+        runner.run('render calendar %s' % mode,
+            lambda: makeView(site, 'calendar', form)(), setup=reset)
+    runner.run('render upcomingevents_view',
+        lambda: makeView(site, 'upcomingevents_view', {})(), setup=reset)
+
+
+def compare(old, new):
+    """
+        (name, old median, new median, ratio) for benchmarks in
+        both result sets; a ratio above 1 is a slowdown.
+    """
+
+    rez = []
+    for name in sorted(new['results']):
+        before = old['results'].get(name)
+        if before is None:
+            continue
+        after = new['results'][name]
+        ratio = before['median'] and after['median'] / before['median'] or 0.0
+        rez.append((name, before['median'], after['median'], round(ratio, 3)))
+    return rez
+
+
+def main(app, argv):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('--site', help="path of the calendar site in the app")
+    parser.add_option('--load', action='store_true', default=False,
+        help="replace the calendar tables with the synthetic data")
+    parser.add_option('--warm', action='store_true', default=False,
+        help="leave the query and render caches on between calls")
+    parser.add_option('--orgs', type='int', default=20)
+    parser.add_option('--events', type='int', default=100,
+        help="events per organization")
+    parser.add_option('--cats', type='int', default=6,
+        help="categories per organization")
+    parser.add_option('--cats-per-event', type='int', default=2)
+    parser.add_option('--spread', type='int', default=365,
+        help="days either side of the target date to place events")
+    parser.add_option('--mix', default='',
+        help="recurrence mix, e.g. once=0.6,weekly=0.3,monthly=0.1")
+    parser.add_option('--seed', type='int', default=1)
+    parser.add_option('--date', help="target date, YYYY-MM-DD")
+    parser.add_option('--repeat', type='int', default=5)
+    parser.add_option('--output', help="write results as JSON to this file")
+    parser.add_option('--compare', help="JSON results of an earlier run")
+    options, args = parser.parse_args(argv)
+
+    mix = None
+    if options.mix:
+        mix = {}
+        for part in options.mix.split(','):
+            kind, share = part.split('=')
+            mix[kind.strip()] = float(share)
+    target = options.date and caldate.parseDateString(options.date) or date.today()
+
+    params = {
+        'orgs': options.orgs,
+        'events_per_org': options.events,
+        'cats_per_org': options.cats,
+        'cats_per_event': options.cats_per_event,
+        'spread': options.spread,
+        'mix': mix or recurrence_mix,
+        'seed': options.seed,
+        }
+    tables = generate(start=target, **params)
+    runner = Runner(options.repeat)
+
+    pureBenchmarks(runner, tables, target)
+
+    if options.site:
+        import transaction
+        from Testing.makerequest import makerequest
+        try:
+            from zope.site.hooks import setSite
+        except ImportError:
+            from zope.app.component.hooks import setSite
+
+        app = makerequest(app)
+        site = app.unrestrictedTraverse(options.site)
+        setSite(site)
+        if options.load:
+            from dcn.eventreader.browser.dbaccess import \
+                IEventDatabaseWriteProvider
+            writer = IEventDatabaseWriteProvider(site)
+            loadTables(writer.reader.query, tables)
+            # every organization's, not just the site's
+            writer.db_org_id = 0
+            writer.rebuildOccurrences()
+            transaction.commit()
+        siteBenchmarks(runner, site, tables, target, options.warm)
+        transaction.abort()
+
+    output = {
+        'created': now(),
+        'date': target.isoformat(),
+        'python': platform.python_version(),
+        'params': params,
+        'rows': dict([(name, len(rows)) for name, rows in tables.items()]),
+        'site': options.site,
+        'warm': options.warm,
+        'results': runner.results,
+        }
+    text = json.dumps(output, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(text)
+    else:
+        print text
+
+    if options.compare:
+        with open(options.compare) as f:
+            old = json.load(f)
+        for name, before, after, ratio in compare(old, output):
+            print >> sys.stderr, "%-40s %10.3f %10.3f %7.3fx" % (
+                name, before, after, ratio)
+
+
+if __name__ == '__main__':
+    # bin/instance run puts the Zope application in app
+    main(globals().get('app'), sys.argv[1:])
@@ -0,0 +1,127 @@
+"""
+
+Process-wide result caches
+
+Entries are tagged with the organization ids they were built from
+so that writes can throw away only what they affect. An entry with
+no oids (the community calendar) depends on every organization.
+
+Each ZEO client keeps its own caches; writes made through another
+client only show up here once the TTL runs out.
+
+    >>> c = LRUCache(2, 60)
+    >>> c.set('a', 1, oids=(1, ))
+    >>> c.set('b', 2, oids=(2, ))
+    >>> c.get('a')
+    1
+    >>> c.set('c', 3)
+    >>> c.get('b') is None
+    True
+    >>> c.invalidateOrg(5)
+    >>> c.get('a'), c.get('c')
+    (1, None)
+    >>> c.invalidateOrg(1)
+    >>> len(c)
+    0
+
+"""
+
+import threading
+from collections import OrderedDict
+from time import time
+
+
+# every cache that write providers should invalidate
+_registry = []
+
+
+class LRUCache(object):
+    """
+        Size-bounded, time-limited cache with least-recently-used
+        eviction. A maxsize of 0 turns the cache off.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> (expires, oids, value) in LRU order
+        self._entries = OrderedDict()
+        # oid -> set of keys; keys tagged with no oid live in _global
+        self._by_oid = {}
+        self._global = set()
+        _registry.append(self)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _discard(self, key):
+        expires, oids, value = self._entries.pop(key)
+        if oids:
+            for oid in oids:
+                keys = self._by_oid.get(oid)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self._by_oid[oid]
+        else:
+            self._global.discard(key)
+
+    def get(self, key, default=None):
+        if not self.maxsize:
+            return default
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if entry[0] < time():
+                self._discard(key)
+                return default
+            # move to most-recently-used end
+            del self._entries[key]
+            self._entries[key] = entry
+            return entry[2]
+
+    def set(self, key, value, oids=()):
+        if not self.maxsize:
+            return
+        oids = tuple(oids)
+        with self._lock:
+            if key in self._entries:
+                self._discard(key)
+            self._entries[key] = (time() + self.ttl, oids, value)
+            if oids:
+                for oid in oids:
+                    self._by_oid.setdefault(oid, set()).add(key)
+            else:
+                self._global.add(key)
+            while len(self._entries) > self.maxsize:
+                self._discard(next(iter(self._entries)))
+
+    def invalidateOrg(self, oid):
+        """ drop entries that depend on organization oid """
+
+        with self._lock:
+            keys = self._by_oid.get(oid, set()) | self._global
+            for key in keys:
+                self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_oid.clear()
+            self._global.clear()
+
+
+def invalidateOrg(oid):
+    """ drop entries depending on oid from every registered cache """
+
+    for cache in _registry:
+        cache.invalidateOrg(oid)
+
+
+def clearAll():
+    """ empty every registered cache """
+
+    for cache in _registry:
+        cache.clear()
@@ -102,6 +102,44 @@ DocTests for caldate
     >>> monthly(start, datetime.date(2009, 7, 31), datetime.date(2009, 5, 12))
     [datetime.date(2009, 5, 12), datetime.date(2009, 6, 9), datetime.date(2009, 7, 14)]
 
+    The engine underneath works on ordinals:
+
+    >>> len(occurrenceOrdinals(datetime.date(2012, 1, 1), datetime.date(2012, 12, 31), datetime.date(2011, 6, 1), 'daily'))
+    366
+
+    >>> list(occurrenceOrdinals(start, end, start, 'weekly')) == [d.toordinal() for d in weekly(start, end, start)]
+    True
+
+    >>> list(iterOccurrences(start, datetime.date(2009, 7, 31), datetime.date(2009, 5, 12), 'monthly'))
+    [datetime.date(2009, 5, 12), datetime.date(2009, 6, 9), datetime.date(2009, 7, 14)]
+
+    An event first held on the 7th, 14th, 21st or 28th starts that
+    week's run; it doesn't skip to the next week:
+
+    >>> [monthly(datetime.date(2009, 5, 1), datetime.date(2009, 6, 30), datetime.date(2009, 5, d)) for d in (7, 14)]
+    [[datetime.date(2009, 5, 7), datetime.date(2009, 6, 4)], [datetime.date(2009, 5, 14), datetime.date(2009, 6, 11)]]
+
+    >>> [monthly(datetime.date(2009, 5, 1), datetime.date(2009, 6, 30), datetime.date(2009, 5, d)) for d in (21, 28)]
+    [[datetime.date(2009, 5, 21), datetime.date(2009, 6, 18)], [datetime.date(2009, 5, 28), datetime.date(2009, 6, 25)]]
+
+    Monthly dates outside the window are dropped:
+
+    >>> monthly(datetime.date(2009, 5, 15), end, datetime.date(2009, 4, 1))
+    []
+
+    >>> rows = [(start, end, 'biweekly'), (datetime.date(2009, 5, 12), datetime.date(2009, 7, 31), 'monthly')]
+    >>> indexes, ordinals = expandRows(rows, datetime.date(2009, 5, 10), datetime.date(2009, 6, 30))
+    >>> list(indexes)
+    [0, 0, 1, 1]
+    >>> [datetime.date.fromordinal(o) for o in ordinals]
+    [datetime.date(2009, 5, 15), datetime.date(2009, 5, 29), datetime.date(2009, 5, 12), datetime.date(2009, 6, 9)]
+
+    >>> expand(start, datetime.date(2009, 7, 31), datetime.date(2009, 5, 12), 'monthly')
+    [datetime.date(2009, 5, 12), datetime.date(2009, 6, 9), datetime.date(2009, 7, 14)]
+
+    >>> expand(start, end, datetime.date(2009, 5, 30), 'irregular')
+    [datetime.date(2009, 5, 30), datetime.date(2009, 5, 31)]
+
     >>> startOfWeek(datetime.date(2012, 8, 21))
     datetime.date(2012, 8, 19)
 
@@ -114,42 +152,147 @@ DocTests for caldate
 """
 import re
 import datetime
+from array import array
+from calendar import isleap
 from datetime import date, timedelta
+from itertools import imap, repeat
 
 # date splitting pattern
 spat = re.compile(r"[/-]")
 
 aday = timedelta(1)
 
+# days in each month of a common year
+month_days = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
 
 def parseDateString(datestring):
     return date(*[int(s) for s in spat.split(datestring)])
 
 
+def toOrdinal(adate):
+    """
+      Proleptic Gregorian ordinal for a date, datetime
+      or Zope DateTime
+    """
+
+    try:
+        return adate.toordinal()
+    except AttributeError:
+        return date(adate.year(), adate.month(), adate.day()).toordinal()
+
+
+def strideOrdinals(lo, hi, origin, stride):
+    """
+      Ordinals from lo to hi, inclusive, that are a whole
+      number of strides from origin
+    """
+
+    return xrange(lo + (origin - lo) % stride, hi + 1, stride)
+
+
+def monthlyOrdinals(lo, hi, origin):
+    """
+      Ordinals from lo to hi, inclusive, falling on the same
+      week-of-month and weekday as origin
+    """
+
+    target = date.fromordinal(origin)
+    # days 1-7 are the first week, 8-14 the second, ...
+    week_ofs = (target.day - 1) // 7 * 7
+    tdow = target.weekday()
+    first = date.fromordinal(lo)
+    year, month = first.year, first.month
+    month_start = lo - first.day + 1
+    while month_start <= hi:
+        days = month_days[month - 1]
+        if month == 2 and isleap(year):
+            days += 1
+        # ordinal 1 is a Monday, weekday 0
+        ofs = week_ofs + (tdow - (month_start + 6)) % 7
+        if ofs < days and lo <= month_start + ofs <= hi:
+            yield month_start + ofs
+        month_start += days
+        if month == 12:
+            year, month = year + 1, 1
+        else:
+            month += 1
+
+
+# days between occurrences for fixed-count recurrences
+strides = {
+    'weekly': 7,
+    'biweekly': 14,
+    }
+
+
+def _ordinals(lo, hi, origin, recurs):
+    if lo > hi:
+        return ()
+    if recurs == 'monthly':
+        return monthlyOrdinals(lo, hi, origin)
+    return strideOrdinals(lo, hi, origin, strides.get(recurs, 1))
+
+
+def occurrenceOrdinals(start, end, target, recurs):
+    """
+      Ordinals of the dates from start to end, inclusive, on which
+      an event first held on target occurs; unknown recurrences are
+      treated as daily. Daily, weekly and biweekly come back as
+      xrange objects, so len() is free; monthly as an iterator.
+    """
+
+    return rangeOrdinals(toOrdinal(start), toOrdinal(end), toOrdinal(target), recurs)
+
+
+def rangeOrdinals(lo, hi, origin, recurs):
+    """
+      occurrenceOrdinals with the window and first date as ordinals
+    """
+
+    return _ordinals(max(lo, origin), hi, origin, recurs)
+
+
+def iterOccurrences(start, end, target, recurs):
+    """
+      Lazy occurrenceOrdinals, as dates
+    """
+
+    return imap(date.fromordinal, occurrenceOrdinals(start, end, target, recurs))
+
+
+def expandRows(rows, start, end):
+    """
+      Expand a sequence of (start, end, recurs) rows over the window
+      start to end. Returns two parallel arrays: the index in rows of
+      each occurrence and the occurrence's ordinal.
+    """
+
+    lo = toOrdinal(start)
+    hi = toOrdinal(end)
+    indexes = array('l')
+    ordinals = array('l')
+    for i, (rstart, rend, recurs) in enumerate(rows):
+        origin = toOrdinal(rstart)
+        count = len(ordinals)
+        ordinals.extend(_ordinals(max(lo, origin), min(hi, toOrdinal(rend)), origin, recurs))
+        indexes.extend(repeat(i, len(ordinals) - count))
+    return indexes, ordinals
+
+
 def hardRecurr(start, end, target, offset):
     """
       For fixed-day count recurrance
     """
 
-    tdoffset = timedelta(offset)
-    res = []
-    if target <= end:
-        if start < target:
-            start = target
-        day = start + timedelta(((target - start).days + offset) % offset)
-        while day <= end:
-            res.append(day)
-            day += tdoffset
-    return res
+    origin = target.toordinal()
+    lo = max(start.toordinal(), origin)
+    return [date.fromordinal(o) for o in
+        strideOrdinals(lo, end.toordinal(), origin, offset)]
 
 
 def daily(start, end, target):
-    adate = max(start, target)
-    res = []
-    while adate <= end:
-        res.append(adate)
-        adate += aday
-    return res
+    return [date.fromordinal(o) for o in occurrenceOrdinals(start, end, target, 'daily')]
 
 
 def weekly(start, end, target):
@@ -190,26 +333,16 @@ def monthly(start, end, target):
       Follow an xth weekday in month pattern
     """
 
-    week = target.day / 7
+    return [date.fromordinal(o) for o in occurrenceOrdinals(start, end, target, 'monthly')]
 
-    if target > start:
-        monthStart = startOfMonth(target)
-    else:
-        monthStart = startOfMonth(start)
-
-    res = []
-    while monthStart <= end:
-        tdow = target.weekday()
-        msdow = monthStart.weekday()
-        if tdow >= msdow:
-            ofs = tdow - msdow
-        else:
-            ofs = 7 - (msdow - tdow)
-        date = monthStart + timedelta(week * 7 + ofs)
-        if monthStart <= date <= endOfMonth(monthStart):
-            res.append(date)
-        monthStart = startOfNextMonth(monthStart)
-    return res
+
+def expand(start, end, target, recurs):
+    """
+      Dates between start and end for an event starting on target
+      that recurs as recurs; anything unknown is treated as daily.
+    """
+
+    return list(iterOccurrences(start, end, target, recurs))
 
 
 def startOfWeek(target):
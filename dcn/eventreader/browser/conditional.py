@@ -0,0 +1,52 @@
+"""
+
+HTTP conditional GET support
+
+"""
+
+from email.utils import formatdate, mktime_tz, parsedate_tz
+from hashlib import md5
+
+
+def makeETag(*parts):
+    """ strong entity tag from a freshness token """
+
+    return '"%s"' % md5(repr(parts)).hexdigest()
+
+
+def isNotModified(request, etag, last_modified=None):
+    """
+        Send ETag and Last-Modified (seconds since the epoch)
+        validators. If the request's If-None-Match or
+        If-Modified-Since says the client's copy is current,
+        set a 304 status and return True; the caller should
+        then skip rendering.
+    """
+
+    response = request.response
+    response.setHeader('ETag', etag)
+    if last_modified is not None:
+        response.setHeader(
+            'Last-Modified', formatdate(last_modified, usegmt=True))
+    if not response.getHeader('Cache-Control'):
+        response.setHeader('Cache-Control', 'max-age=0, must-revalidate')
+
+    if request.get('REQUEST_METHOD', 'GET') not in ('GET', 'HEAD'):
+        return False
+
+    fresh = False
+    if_none_match = request.getHeader('If-None-Match')
+    if if_none_match is not None:
+        # If-None-Match wins over If-Modified-Since
+        tags = [t.strip() for t in if_none_match.split(',')]
+        fresh = '*' in tags or etag in tags or ('W/%s' % etag) in tags
+    elif last_modified is not None:
+        since = request.getHeader('If-Modified-Since')
+        if since:
+            parsed = parsedate_tz(since.split(';')[0])
+            if parsed is not None:
+                fresh = int(last_modified) <= mktime_tz(parsed)
+
+    if fresh:
+        response.setStatus(304)
+    return fresh
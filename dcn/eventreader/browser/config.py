@@ -0,0 +1,76 @@
+"""
+
+Process-wide settings
+
+Settings come from an optional dcn.eventreader section in zope.conf:
+
+    <product-config dcn.eventreader>
+        query-cache-size 500
+        query-cache-ttl 300
+    </product-config>
+
+Anything not set there falls back to the defaults below.
+
+"""
+
+from App.config import getConfiguration
+
+
+defaults = {
+    # eventsByDateRange result cache; size 0 turns it off
+    'query-cache-size': 500,
+    'query-cache-ttl': 300,
+    # rendered anonymous @@calendar pages; size 0 turns it off
+    'render-cache-size': 200,
+    'render-cache-ttl': 600,
+    # read and maintain the materialized EvOccurrences table;
+    # run @@rebuild-occurrences at the site root before turning on
+    'use-occurrence-table': False,
+    # ping pooled connections idle this many seconds before use;
+    # close and reopen those idle longer than the timeout
+    'db-ping-interval': 30,
+    'db-idle-timeout': 3600,
+    # reload the Orgs/GlobalCategories snapshot this often
+    'directory-ttl': 300,
+    # database file for the SQLite stand-in (sqlite-overrides.zcml);
+    # empty means eventreader.sqlite in the instance's var directory
+    'sqlite-file': '',
+    # per-request phase timings in a Server-Timing header; requests
+    # slower than slow-request-ms are also logged (0 turns that off)
+    'server-timing': False,
+    'slow-request-ms': 0,
+    # query eventsByDateRange in parallel shards of this many
+    # organizations when there are more (0 turns that off)
+    'shard-size': 0,
+    'shard-threads': 4,
+    # ids of database adapters replicating dbCal, acquired like it;
+    # EventDatabaseProvider reads from them (empty reads from dbCal).
+    # A replica that fails is skipped for replica-retry seconds.
+    'read-replicas': '',
+    'replica-retry': 30,
+    # after a write, read from dbCal for this long, in the process
+    # and, through a cookie, for the editor who wrote
+    'primary-pin-seconds': 10,
+    }
+
+
+def getSetting(name):
+    """ return the configured value for name, coerced to
+        the type of its default.
+    """
+
+    default = defaults[name]
+    product_config = getattr(getConfiguration(), 'product_config', None)
+    if not product_config:
+        return default
+    val = product_config.get('dcn.eventreader', {}).get(name)
+    if val is None:
+        return default
+    if type(default) == bool:
+        return str(val).strip().lower() in ('1', 'on', 'true', 'yes')
+    if type(default) in (int, float):
+        try:
+            return type(default)(val)
+        except ValueError:
+            return default
+    return val
@@ -4,18 +4,32 @@ Database access
 
 """
 
-import datetime
+import heapq
+import threading
+from datetime import date
+from multiprocessing.pool import ThreadPool
+from time import time
 
 import Acquisition
+import transaction
 
 # from zope.component import getMultiAdapter
 from zope import interface
+from zope.annotation.interfaces import IAnnotations
 
 from Shared.DC.ZRDB.Results import Results
 
 from plone.app.layout.navigation.interfaces import INavigationRoot
 
+import cache
 import caldate
+import directory
+import formatting
+import pool
+import records
+import replicas
+import timing
+from config import getSetting
 
 
 class IEventDatabaseProvider(interface.Interface):
@@ -48,6 +62,31 @@ class IEventDatabaseProvider(interface.Interface):
         Also, optionally, selects by several criteria from kwa.
         """
 
+    def occurrencesByDateRange(self, start, end, org_list, limit=None, **kwa):
+        """
+        Like eventsByDateRange, but returns one row per
+        occurrence date, in date and starting time order.
+        If limit is given, return no more than limit rows.
+        """
+
+    def lastModified(self, org_list):
+        """
+            Returns (last update as seconds since the epoch, event count)
+            for events of the organizations in org_list, or all events.
+        """
+
+    def eventLastModified(self, eid):
+        """
+            Returns the event's last update as seconds since the
+            epoch, or None if there's no such event.
+        """
+
+    def directoryFingerprint(self):
+        """
+            Returns a digest of the organizations and categories,
+            which changes when they do.
+        """
+
     def getEvent(self, eid):
         """ return an event object matching eid """
 
@@ -62,6 +101,14 @@ class IEventDatabaseProvider(interface.Interface):
             that want community calendar links
         """
 
+    def getEventBundle(self, eids):
+        """
+            Returns {eid: bundle} for the events in eids that exist.
+            Each bundle is a dict with keys event (as getEvent),
+            dates (as getEventDates), cats (a list of gcids) and
+            org (as getOrgData).
+        """
+
 
 class IEventDatabaseWriteProvider(interface.Interface):
     """
@@ -119,10 +166,27 @@ class IEventDatabaseWriteProvider(interface.Interface):
             start, end are datetime dates.
         """
 
-    def updateEvent(self, eid, user_name, **kwa):
+    def updateEvent(self, eid, user_name, version=None, **kwa):
         """
             kwa should dereference to a dict of values
-            keyed by column
+            keyed by column. If version (lastUpdated, as read)
+            is given and the event has changed since, raise
+            EventConflictError.
+        """
+
+    def saveEvent(self, eid, member, gcids, dates, version=None, **kwa):
+        """
+            Insert (eid 0) or update an event, and apply only the
+            category and date changes needed to reach gcids and
+            dates, a sequence of (start, end, recurs). Returns eid.
+            Checks version as updateEvent does.
+        """
+
+    def rebuildOccurrences(self):
+        """
+            Recreate EvOccurrences rows from EvDates for our
+            organization, or for everyone if we have none.
+            Returns the number of occurrences written.
         """
 
     def lastEventInsertId(self):
@@ -134,6 +198,10 @@ class IEventDatabaseWriteProvider(interface.Interface):
         """ return org for specified org """
 
 
+class EventConflictError(Exception):
+    """ the event was changed by someone else since it was read """
+
+
 # decode string from win1252
 def decodeString(val):
     return val.decode('Windows-1252', 'replace')
@@ -166,6 +234,174 @@ def cleanDate(adate):
     return adate.strftime('%Y-%m-%d')
 
 
+def displayTimes(adict):
+    """ begins and ends, as seconds, to display form """
+
+    for key in ('begins', 'ends'):
+        adict[key] = formatting.timeDisplay(
+            formatting.secondsToTime(adict[key]))
+
+
+def dateRecord(row):
+    """ EvDates row with start and end as day ordinals to a Record """
+
+    return directory.Record(
+        eid=row.eid,
+        start=date.fromordinal(row.start),
+        end=date.fromordinal(row.end),
+        recurs=row.recurs,
+        )
+
+
+# eventsByDateRange results shared by every thread in the process
+query_cache = cache.LRUCache(
+    getSetting('query-cache-size'),
+    getSetting('query-cache-ttl'),
+    )
+
+# request annotations for shared results and query counts
+request_cache_key = 'dcn.eventreader.request-cache'
+query_count_key = 'dcn.eventreader.query-count'
+
+
+def requestAnnotations(request):
+    if request is None:
+        return None
+    return IAnnotations(request, None)
+
+
+def requestCache(request):
+    """ dict of results for this request, or None outside one """
+
+    annotations = requestAnnotations(request)
+    if annotations is None:
+        return None
+    return annotations.setdefault(request_cache_key, {})
+
+
+def clearRequestCache(request):
+    annotations = requestAnnotations(request)
+    if annotations is not None:
+        annotations.pop(request_cache_key, None)
+
+
+def countQuery(request):
+    annotations = requestAnnotations(request)
+    if annotations is not None:
+        annotations[query_count_key] = annotations.get(query_count_key, 0) + 1
+
+
+def queryCount(request):
+    """ number of SQL queries run so far for request """
+
+    annotations = requestAnnotations(request)
+    if annotations is None:
+        return 0
+    return annotations.get(query_count_key, 0)
+
+
+# Orgs and GlobalCategories, shared by every thread in the process
+org_directory = directory.Directory(getSetting('directory-ttl'))
+
+# dbCal and dbCalWriter connections for both providers
+connection_pool = pool.ConnectionPool(
+    getSetting('db-ping-interval'),
+    getSetting('db-idle-timeout'),
+    )
+
+# eventsByDateRange filters and their "no filter" values
+range_filters = (
+    ('public', 'b'),
+    ('free', 'b'),
+    ('common', 'b'),
+    ('udf1', None),
+    ('udf2', None),
+    ('gcid', None),
+    )
+
+
+# threads for sharded eventsByDateRange queries; made on first use
+_shard_pool = None
+_shard_pool_lock = threading.Lock()
+
+
+def shardPool():
+    global _shard_pool
+    with _shard_pool_lock:
+        if _shard_pool is None:
+            _shard_pool = ThreadPool(max(getSetting('shard-threads'), 1))
+    return _shard_pool
+
+
+def shardList(oids, size):
+    """ sorted, distinct oids in runs of size
+
+        >>> shardList([5, 1, 3, 2, 1], 2)
+        [[1, 2], [3, 5]]
+    """
+
+    oids = sorted(set([int(i) for i in oids]))
+    return [oids[i:i + size] for i in range(0, len(oids), size)]
+
+
+def rangeKey(rec):
+    # the range query's ORDER BY; MySQL sorts NULL times first
+    # and compares titles without case
+    return (
+        rec['start'],
+        formatting.timeKey(rec['startTime']),
+        (rec['title'] or u'').lower(),
+        )
+
+
+def _decorate(i, rows):
+    for row in rows:
+        yield rangeKey(row), i, row
+
+
+def mergeRanges(parts):
+    """ merge range query results, each already in order, into one list """
+
+    return [row for key, i, row in heapq.merge(*[
+        _decorate(i, rows) for i, rows in enumerate(parts)])]
+
+
+# materialized recurrence expansion of EvDates: one row per
+# event per day it occurs; maintained by EventDatabaseWriteProvider
+occurrences_ddl = """
+    CREATE TABLE IF NOT EXISTS EvOccurrences (
+        eid int(11) NOT NULL,
+        date date NOT NULL,
+        PRIMARY KEY (date, eid),
+        KEY eid (eid)
+    )
+"""
+
+# rows per INSERT when writing occurrences
+occurrence_batch = 1000
+
+
+def occurrenceValues(eid, dates):
+    """
+        SQL value tuples for the occurrences of eid
+        over dates, a sequence of (start, end, recurs)
+    """
+
+    days = set()
+    for sdate, edate, recurs in dates:
+        days.update(caldate.expand(sdate, edate, sdate, recurs))
+    return ["(%i, '%s')" % (eid, day.isoformat()) for day in sorted(days)]
+
+
+def rangeCacheKey(start, end, org_list, kwa,
+        method='eventsByDateRange', limit=None):
+    """ normalized cache key for a date-range query """
+
+    oids = tuple(sorted(set([int(i) for i in org_list or ()])))
+    filters = tuple([kwa.get(key, default) for key, default in range_filters])
+    return (method, start, end, oids, filters, limit)
+
+
 class EventDatabaseProvider(object):
     """
         Provides event database access methods
@@ -173,10 +409,15 @@ class EventDatabaseProvider(object):
 
     interface.implements(IEventDatabaseProvider)
 
+    # (id, adapter, DB object) of the replica we read from; False
+    # once we've found there's none to use
+    _replica = None
+
     def __init__(self, context):
         self.context = context
         self.dbCal = Acquisition.aq_get(context, 'dbCal')
-        self.reader = self.dbCal()
+        self.reader = connection_pool.checkout(self.dbCal)
+        self.request = Acquisition.aq_get(context, 'REQUEST', None)
         if INavigationRoot.providedBy(context):
             self.db_org_id = getattr(context, 'dbOrgId', 0)
         else:
@@ -185,6 +426,68 @@ class EventDatabaseProvider(object):
     def _sql_quote(self, astring):
         return self.dbCal.sql_quote__(astring)
 
+    def _query(self, query):
+        countQuery(self.request)
+        timings = timing.getTimings(self.request)
+        if timings is None:
+            return self._read(query)
+        with timings.timer('sql'):
+            result = self._read(query)
+        timings.addRows('sql', len(result[1]))
+        return result
+
+    def _read(self, query):
+        """
+        Run query on our replica; on dbCal if there's none, or
+        if it fails
+        """
+
+        replica = self._readReplica()
+        if not replica:
+            return self.reader.query(query)
+        name, da, db = replica
+        started = time()
+        try:
+            result = db.query(query)
+        except Exception:
+            # if dbCal fails too, blame the query, not the replica
+            self._replica = False
+            result = self.reader.query(query)
+            replicas.logger.warning(
+                "read from replica %s failed", name, exc_info=True)
+            replicas.replica_set.failed(name)
+            return result
+        replicas.replica_set.succeeded(name, time() - started)
+        return result
+
+    def _readReplica(self):
+        """
+        (id, adapter, DB object) of the replica to read from, chosen
+        on first use; None when reads should go to dbCal
+        """
+
+        if not replicas.replica_set or replicas.pinned(self.request):
+            return None
+        if self._replica is None:
+            self._replica = False
+            name = replicas.replica_set.choose()
+            if name is not None:
+                da = Acquisition.aq_get(self.context, name, None)
+                try:
+                    self._replica = (name, da, connection_pool.checkout(da))
+                except Exception:
+                    replicas.logger.warning(
+                        "can't connect to replica %s", name, exc_info=True)
+                    replicas.replica_set.failed(name)
+        return self._replica or None
+
+    def _directory(self):
+        """ org_directory, brought up to date """
+
+        org_directory.sync(
+            lambda query: Results(self._query(query)).dictionaries())
+        return org_directory
+
     def getOrgData(self, oid=0):
         """
         Returns organization's data as a dict
@@ -193,17 +496,12 @@ class EventDatabaseProvider(object):
         oid = oid or self.db_org_id
         assert(oid != 0)
 
-        query = """
-            SELECT * FROM Orgs WHERE oid = %s
-        """ % (self._sql_quote(oid))
-
-        dicts = Results(self.reader.query(query)).dictionaries()
-        if len(dicts) == 1:
-            adict = dicts[0]
-            decodeStrings(adict)
-            return adict
-        else:
+        org = self._directory().org(int(oid))
+        if org is None:
             return None
+        adict = dict(org)
+        decodeStrings(adict)
+        return adict
 
     def getCats(self, oid=0):
         """
@@ -211,13 +509,7 @@ class EventDatabaseProvider(object):
             obj attributes: title, gcid
         """
 
-        query = """
-            select title, gcid from GlobalCategories
-            where oid = %i
-            order by title
-        """ % oid
-
-        return Results(self.reader.query(query))
+        return self._directory().cats(oid)
 
     def getOrgCats(self):
         """
@@ -233,6 +525,30 @@ class EventDatabaseProvider(object):
         dates between start and end
         for organizations in org_list.
         Also, optionally, selects by several criteria from kwa.
+        Rows are read-only EventRecords shared through query_cache.
+        """
+
+        key = rangeCacheKey(start, end, org_list, kwa)
+        store = requestCache(self.request)
+        if store is not None and key in store:
+            return store[key]
+        if replicas.sessionPinned(self.request):
+            # cached rows may predate the editor's own write
+            dicts = None
+        else:
+            dicts = query_cache.get(key)
+        if dicts is None:
+            dicts = self._eventsByDateRange(start, end, org_list, **kwa)
+            query_cache.set(key, dicts, oids=key[3])
+        if store is not None:
+            store[key] = dicts
+        return dicts
+
+    def _rangeFilters(self, org_list, kwa):
+        """
+        Returns (from, where) SQL fragments for the
+        eventsByDateRange selection criteria.
+        Events are e; categories, if needed, are EvCats.
         """
 
         if org_list:
@@ -277,18 +593,92 @@ class EventDatabaseProvider(object):
             gcid_test = ""
             gcid_from = ""
         else:
-            gcid_test = "AND EvCats.eid = ev.eid AND EvCats.gcid = %d" % gcid
+            gcid_test = "AND EvCats.eid = e.eid AND EvCats.gcid = %d" % gcid
             gcid_from = ", EvCats"
 
-        query = """
+        return gcid_from, " ".join((
+            oid_test, public_test, free_test, common_test,
+            udf1_test, udf2_test, gcid_test,
+            ))
+
+    def _eventsByDateRange(self, start, end, org_list, **kwa):
+        """
+        Uncached eventsByDateRange. With the shard-size setting on,
+        more organizations than that (all of them, for an empty
+        org_list) are queried in shards, in parallel.
+        """
+
+        shard_size = getSetting('shard-size')
+        if shard_size:
+            oids = org_list or [org.oid for org in self._directory().orgs()]
+            if len(oids) > shard_size:
+                return self._shardedEventsByDateRange(
+                    start, end, shardList(oids, shard_size), kwa)
+        return records.makeRecords(
+            self._query(self._rangeQuery(start, end, org_list, kwa)))
+
+    def _shardedEventsByDateRange(self, start, end, shards, kwa):
+        """
+        Run the range query for each list of oids in shards on the
+        shard pool's threads, each with its own connection, and merge
+        the results. Worker threads leave the request alone: queries
+        are counted and timed here.
+        """
+
+        queries = [self._rangeQuery(start, end, oids, kwa) for oids in shards]
+        spec = self._workerSpec()
+        reader = self._workerReader
+
+        def run(query):
+            try:
+                return reader(spec).query(query)
+            finally:
+                # the query joined this thread's transaction; end it,
+                # so the connection's next query sees new rows
+                transaction.abort()
+
+        timings = timing.getTimings(self.request)
+        if timings is None:
+            results = shardPool().map(run, queries)
+        else:
+            with timings.timer('sql'):
+                results = shardPool().map(run, queries)
+            timings.addRows('sql', sum([len(rows) for items, rows in results]))
+        for query in queries:
+            countQuery(self.request)
+        return mergeRanges([records.makeRecords(result) for result in results])
+
+    def _workerSpec(self):
+        """
+        What shard workers connect with: the pool.adapterSpec of
+        our replica, or of dbCal. Persistent adapters belong to
+        the request's thread, so this is read there.
+        """
+
+        replica = self._readReplica()
+        return pool.adapterSpec(replica and replica[1] or self.dbCal)
+
+    def _workerReader(self, spec):
+        """ a DB object from spec for a shard worker thread """
+
+        return connection_pool.dedicated(spec)
+
+    def _rangeQuery(self, start, end, org_list, kwa):
+        """
+        SQL for eventsByDateRange
+        """
+
+        filter_from, filter_where = self._rangeFilters(org_list, kwa)
+
+        return """
             SELECT DISTINCT
-             e.eid, e.title, e.description, e.startTime, e.endTime,
+             e.eid, e.title, e.description,
+             TIME_TO_SEC(e.startTime) as startTime,
+             TIME_TO_SEC(e.endTime) as endTime,
              e.location, e.eventUrl,
              o.acronym, o.name as orgname, o.url,
-             DATE_FORMAT(ev.sdate, "%%Y-%%m-%%d") as start,
-             DATE_FORMAT(ev.edate, "%%Y-%%m-%%d") as end,
-             TIME_FORMAT(e.startTime, "%%l:%%i %%p") as begins,
-             TIME_FORMAT(e.endTime, "%%l:%%i %%p") as ends,
+             TO_DAYS(ev.sdate) - 365 as start,
+             TO_DAYS(ev.edate) - 365 as end,
              ev.recurs
              FROM EvDates ev, Events e, Orgs o %s
              WHERE
@@ -296,58 +686,159 @@ class EventDatabaseProvider(object):
                AND ev.eid = e.eid
                AND o.oid = e.oid
                %s
-               %s %s %s %s %s %s
             ORDER BY ev.sdate, e.startTime, e.title
         """ % (
-            gcid_from, cleanDate(end), cleanDate(start),
-            oid_test, public_test, free_test, common_test,
-            udf1_test, udf2_test, gcid_test,
+            filter_from, cleanDate(end), cleanDate(start), filter_where,
             )
 
-        dicts = Results(self.reader.query(query)).dictionaries()
-
-        for adict in dicts:
-            for s in ('start', 'end'):
-                adict[s] = caldate.parseDateString(adict[s])
-            for s in ('begins', 'ends'):
-                adict[s] = adict[s].replace(' ', '').lower()
-            decodeStrings(adict)
+    def occurrencesByDateRange(self, start, end, org_list, limit=None, **kwa):
+        """
+        Like eventsByDateRange, but reads the materialized
+        EvOccurrences table and returns one row per occurrence,
+        sorted by date and starting time. Each row has a date key;
+        start and end are set to that date, and recurs to daily.
+        If limit is given, return no more than limit rows.
+        Rows are read-only EventRecords shared through query_cache.
+        """
 
+        key = rangeCacheKey(start, end, org_list, kwa,
+            method='occurrencesByDateRange', limit=limit)
+        store = requestCache(self.request)
+        if store is not None and key in store:
+            return store[key]
+        if replicas.sessionPinned(self.request):
+            # cached rows may predate the editor's own write
+            dicts = None
+        else:
+            dicts = query_cache.get(key)
+        if dicts is None:
+            dicts = self._occurrencesByDateRange(
+                start, end, org_list, limit=limit, **kwa)
+            query_cache.set(key, dicts, oids=key[3])
+        if store is not None:
+            store[key] = dicts
         return dicts
 
+    def _occurrencesByDateRange(self, start, end, org_list, limit=None, **kwa):
+        """
+        Uncached occurrencesByDateRange
+        """
+
+        filter_from, filter_where = self._rangeFilters(org_list, kwa)
+        if limit:
+            limit_clause = "LIMIT %i" % limit
+        else:
+            limit_clause = ""
+
+        query = """
+            SELECT DISTINCT
+             e.eid, e.title, e.description,
+             TIME_TO_SEC(e.startTime) as startTime,
+             TIME_TO_SEC(e.endTime) as endTime,
+             e.location, e.eventUrl,
+             o.acronym, o.name as orgname, o.url,
+             TO_DAYS(oc.date) - 365 as date,
+             TO_DAYS(oc.date) - 365 as start,
+             TO_DAYS(oc.date) - 365 as end,
+             'daily' as recurs
+             FROM EvOccurrences oc, Events e, Orgs o %s
+             WHERE
+               oc.date BETWEEN "%s" AND "%s"
+               AND oc.eid = e.eid
+               AND o.oid = e.oid
+               %s
+            ORDER BY oc.date, e.startTime, e.title
+            %s
+        """ % (
+            filter_from, cleanDate(start), cleanDate(end), filter_where,
+            limit_clause,
+            )
+
+        return records.makeRecords(self._query(query))
+
+    def lastModified(self, org_list):
+        """
+            Returns (last update as seconds since the epoch, event count)
+            for events of the organizations in org_list, or all events.
+            The count catches deletions.
+        """
+
+        if org_list:
+            oid_test = "WHERE oid in (%s)" % ','.join(
+                [str(int(i)) for i in org_list]
+                )
+        else:
+            oid_test = ""
+
+        query = """
+            SELECT UNIX_TIMESTAMP(MAX(lastUpdated)) AS lastmod,
+             COUNT(*) AS events
+            FROM Events
+            %s
+        """ % oid_test
+        row = Results(self._query(query))[0]
+        return int(row.lastmod or 0), int(row.events)
+
+    def directoryFingerprint(self):
+        """
+            Returns a digest of the organizations and categories,
+            which changes when they do.
+        """
+
+        return self._directory().fingerprint()
+
+    def eventLastModified(self, eid):
+        """
+            Returns the event's last update as seconds since the
+            epoch, or None if there's no such event.
+        """
+
+        query = """
+            SELECT UNIX_TIMESTAMP(lastUpdated) AS lastmod
+            FROM Events
+            WHERE eid = %i
+        """ % eid
+        rows = Results(self._query(query))
+        if len(rows):
+            return int(rows[0].lastmod or 0)
+        return None
+
     def getEvent(self, eid):
         """ return an event object matching eid """
 
         query = """
             SELECT *,
-             TIME_FORMAT(startTime, "%%l:%%i %%p") as begins,
-             TIME_FORMAT(endTime, "%%l:%%i %%p") as ends
+             TIME_TO_SEC(startTime) as begins,
+             TIME_TO_SEC(endTime) as ends,
+             DATE_FORMAT(lastUpdated, "%%Y-%%m-%%d %%H:%%i:%%s") as version
             FROM Events
             WHERE eid = %i
         """ % (eid)
 
-        dicts = Results(self.reader.query(query)).dictionaries()
+        dicts = Results(self._query(query)).dictionaries()
         if len(dicts):
             res = dicts[0]
             decodeStrings(res)
+            displayTimes(res)
             return res
         else:
             return None
 
     def getEventDates(self, eid):
         """ return a list of the dates associated with the
-            event -- as objects.
+            event -- as objects with start and end dates
+            and recurs.
         """
 
         query = """
-            SELECT *,
-                DATE_FORMAT(sdate, "%%Y-%%m-%%d") as start,
-                DATE_FORMAT(edate, "%%Y-%%m-%%d") as end
+            SELECT eid, recurs,
+                TO_DAYS(sdate) - 365 as start,
+                TO_DAYS(edate) - 365 as end
             FROM EvDates
             WHERE eid = %i
             ORDER BY sdate
         """ % (eid)
-        return Results(self.reader.query(query))
+        return [dateRecord(row) for row in Results(self._query(query))]
 
     def getEventCats(self, eid):
         """ return a list of the categories associated with the
@@ -358,7 +849,60 @@ class EventDatabaseProvider(object):
             SELECT gcid from EvCats
             WHERE eid = %i
         """ % (eid)
-        return Results(self.reader.query(query))
+        return Results(self._query(query))
+
+    def getEventBundle(self, eids):
+        """
+            Returns {eid: bundle} for the events in eids that exist.
+            Each bundle is a dict with keys event (as getEvent),
+            dates (as getEventDates), cats (a list of gcids) and
+            org (as getOrgData). Three queries, however many eids.
+        """
+
+        eid_list = ','.join([str(int(eid)) for eid in eids])
+        if not eid_list:
+            return {}
+
+        query = """
+            SELECT *,
+             TIME_TO_SEC(startTime) as begins,
+             TIME_TO_SEC(endTime) as ends,
+             DATE_FORMAT(lastUpdated, "%%Y-%%m-%%d %%H:%%i:%%s") as version
+            FROM Events
+            WHERE eid IN (%s)
+        """ % eid_list
+        bundles = {}
+        for event in Results(self._query(query)).dictionaries():
+            decodeStrings(event)
+            displayTimes(event)
+            bundles[event['eid']] = {
+                'event': event,
+                'dates': [],
+                'cats': [],
+                'org': self.getOrgData(event['oid']),
+                }
+        if not bundles:
+            return bundles
+
+        query = """
+            SELECT eid, recurs,
+                TO_DAYS(sdate) - 365 as start,
+                TO_DAYS(edate) - 365 as end
+            FROM EvDates
+            WHERE eid IN (%s)
+            ORDER BY sdate
+        """ % eid_list
+        for row in Results(self._query(query)):
+            bundles[row.eid]['dates'].append(dateRecord(row))
+
+        query = """
+            SELECT eid, gcid from EvCats
+            WHERE eid IN (%s)
+        """ % eid_list
+        for row in Results(self._query(query)):
+            bundles[row.eid]['cats'].append(row.gcid)
+
+        return bundles
 
     def currentOrgs(self):
         """
@@ -366,10 +910,6 @@ class EventDatabaseProvider(object):
             that want community calendar links
         """
 
-        today = datetime.date.today()
-        som = caldate.startOfMonth(today).isoformat()
-        eom = caldate.endOfMonth(today).isoformat()
-
         # query = """
         #     SELECT DISTINCT o.oid, o.name AS orgname, o.alt_cal_url, o.acronym
         #     FROM EvDates ev, Events e, Orgs o
@@ -381,25 +921,18 @@ class EventDatabaseProvider(object):
         #         AND o.ccal_link =1
         #     ORDER BY orgname
         # """ % (som, eom)
-        query = """
-            SELECT DISTINCT o.oid, o.name AS orgname, o.alt_cal_url, o.acronym
-            FROM Orgs o
-            WHERE
-                o.ccal_link =1
-            ORDER BY orgname
-        """
-        return Results(self.reader.query(query))
+        return [
+            directory.Record(
+                oid=o.oid, orgname=o.name,
+                alt_cal_url=o.alt_cal_url, acronym=o.acronym,
+                )
+            for o in self._directory().orgs() if o.ccal_link == 1
+            ]
 
     def getOrg(self, oid):
         """ return org for specified org """
 
-        query = """
-            SELECT *
-            FROM Orgs
-            WHERE
-                oid = %d
-        """ % int(oid)
-        return Results(self.reader.query(query))[0]
+        return self._directory().org(int(oid))
 
 
 class EventDatabaseWriteProvider(object):
@@ -412,7 +945,8 @@ class EventDatabaseWriteProvider(object):
     def __init__(self, context):
         self.context = context
         self.dbCal = Acquisition.aq_get(context, 'dbCalWriter')
-        self.reader = self.dbCal()
+        self.reader = connection_pool.checkout(self.dbCal)
+        self.request = Acquisition.aq_get(context, 'REQUEST', None)
         if INavigationRoot.providedBy(context):
             self.db_org_id = getattr(context, 'dbOrgId', 0)
         else:
@@ -421,6 +955,50 @@ class EventDatabaseWriteProvider(object):
     def _sql_quote(self, astring):
         return self.dbCal.sql_quote__(astring)
 
+    def _query(self, query):
+        countQuery(self.request)
+        timings = timing.getTimings(self.request)
+        if timings is None:
+            return self.reader.query(query)
+        with timings.timer('sql'):
+            result = self.reader.query(query)
+        timings.addRows('sql', len(result[1]))
+        return result
+
+    def _invalidate(self):
+        """
+            Drop cached results that depend on our organization.
+            Other threads may re-cache old rows before our
+            transaction commits, so we do it again after commit.
+        """
+
+        oid = self.db_org_id
+        cache.invalidateOrg(oid)
+        clearRequestCache(self.request)
+        replicas.pinPrimary(self.request)
+
+        def afterCommit(success):
+            cache.invalidateOrg(oid)
+
+        txn = transaction.get()
+        if getattr(self, '_hooked_txn', None) is not txn:
+            self._hooked_txn = txn
+            txn.addAfterCommitHook(afterCommit)
+
+    def _invalidateDirectory(self, cats=False):
+        """
+            Have org_directory refresh our organization, now and
+            again after commit, when other threads can see it.
+        """
+
+        oid = self.db_org_id
+        org_directory.invalidate(oid, cats)
+
+        def afterCommit(success):
+            org_directory.invalidate(oid, cats)
+
+        transaction.get().addAfterCommitHook(afterCommit)
+
     def updateOrgData(self, **kwa):
         """
             kwa should be a dict with keys matching orgs columns
@@ -442,7 +1020,9 @@ class EventDatabaseWriteProvider(object):
             SET %s
             WHERE oid=%s
         """ % (", ".join(assignments), int(self.db_org_id))
-        self.reader.query(query)
+        self._query(query)
+        self._invalidate()
+        self._invalidateDirectory()
 
     def insertOrg(self, **kwa):
         """
@@ -466,12 +1046,14 @@ class EventDatabaseWriteProvider(object):
             INSERT INTO Orgs SET
             %s
         """ % (", ".join(assignments))
-        self.reader.query(query)
+        self._query(query)
 
         query = """
             select distinct last_insert_id() as liid from Orgs
         """
-        self.db_org_id = Results(self.reader.query(query))[0].liid
+        self.db_org_id = Results(self._query(query))[0].liid
+        self._invalidate()
+        self._invalidateDirectory()
         return self.db_org_id
 
     def updateOrgCats(self, newlist):
@@ -492,7 +1074,7 @@ class EventDatabaseWriteProvider(object):
             where oid = %i
         """ % self.db_org_id
         old_cats = {}
-        for item in Results(self.reader.query(query)):
+        for item in Results(self._query(query)):
             old_cats[decodeString(item.title)] = str(item.gcid)
         to_add = []
         if newlist:
@@ -512,19 +1094,23 @@ class EventDatabaseWriteProvider(object):
             query = """
                 INSERT INTO GlobalCategories values
                 %s""" % ", ".join(inserts)
-            self.reader.query(query)
+            self._query(query)
 
         # delete old, unused categories
         if to_delete:
             query = """
                 DELETE from GlobalCategories
                 WHERE gcid IN (%s)""" % ", ".join(to_delete)
-            self.reader.query(query)
+            self._query(query)
             # and category/event links
             query = """
                 DELETE from EvCats
                 WHERE gcid IN (%s)""" % ", ".join(to_delete)
-            self.reader.query(query)
+            self._query(query)
+
+        if to_add or to_delete:
+            self._invalidate()
+            self._invalidateDirectory(cats=True)
 
     def deleteEvent(self, eid):
         """
@@ -539,7 +1125,8 @@ class EventDatabaseWriteProvider(object):
             DELETE FROM Events
             WHERE eid = %i
         """ % eid
-        self.reader.query(query)
+        self._query(query)
+        self._invalidate()
 
     def deleteEventCats(self, eid):
         """
@@ -554,7 +1141,8 @@ class EventDatabaseWriteProvider(object):
             DELETE FROM EvCats
             WHERE eid = %i
         """ % eid
-        self.reader.query(query)
+        self._query(query)
+        self._invalidate()
 
     def evCatsInsert(self, eid, gcids):
         """
@@ -574,7 +1162,8 @@ class EventDatabaseWriteProvider(object):
                 INSERT INTO EvCats (eid, gcid) VALUES
                 %s
             """ % ',\n'.join(val_segments)
-            self.reader.query(query)
+            self._query(query)
+            self._invalidate()
 
     def deleteEventDates(self, eid):
         """
@@ -589,7 +1178,14 @@ class EventDatabaseWriteProvider(object):
             DELETE FROM EvDates
             WHERE eid = %i
         """ % eid
-        self.reader.query(query)
+        self._query(query)
+        if getSetting('use-occurrence-table'):
+            query = """
+                DELETE FROM EvOccurrences
+                WHERE eid = %i
+            """ % eid
+            self._query(query)
+        self._invalidate()
 
     def evDatesInsert(self, eid, dates):
         """
@@ -602,6 +1198,7 @@ class EventDatabaseWriteProvider(object):
         assert(self.db_org_id != 0)
 
         eid = int(eid)
+        dates = list(dates)
         val_segments = [
             "(%i, '%s', '%s', %s)" % (
                 eid,
@@ -615,16 +1212,104 @@ class EventDatabaseWriteProvider(object):
             INSERT INTO EvDates (eid, sdate, edate, recurs)  VALUES
             %s
         """ % ', '.join(val_segments)
-        self.reader.query(query)
+        self._query(query)
+        if getSetting('use-occurrence-table'):
+            self._insertOccurrences(occurrenceValues(eid, dates))
+        self._invalidate()
+
+    def _insertOccurrences(self, val_segments):
+        """
+            Write EvOccurrences value tuples in batches
+        """
+
+        for i in range(0, len(val_segments), occurrence_batch):
+            query = """
+                INSERT IGNORE INTO EvOccurrences (eid, date) VALUES
+                %s
+            """ % ', '.join(val_segments[i:i + occurrence_batch])
+            self._query(query)
+
+    def rebuildOccurrences(self):
+        """
+            Recreate EvOccurrences rows from EvDates for our
+            organization, or for everyone if we have none.
+            Returns the number of occurrences written.
+        """
+
+        self._query(occurrences_ddl)
+
+        if self.db_org_id:
+            oid_test = "AND e.oid = %i" % self.db_org_id
+        else:
+            oid_test = ""
+        query = """
+            SELECT ev.eid,
+             TO_DAYS(ev.sdate) - 365 as start,
+             TO_DAYS(ev.edate) - 365 as end,
+             ev.recurs
+            FROM EvDates ev, Events e
+            WHERE ev.eid = e.eid
+             %s
+        """ % oid_test
+        by_eid = {}
+        for row in Results(self._query(query)):
+            by_eid.setdefault(row.eid, []).append((
+                date.fromordinal(row.start),
+                date.fromordinal(row.end),
+                row.recurs,
+                ))
+
+        if self.db_org_id:
+            query = """
+                DELETE FROM EvOccurrences
+                WHERE eid IN (SELECT eid FROM Events WHERE oid = %i)
+            """ % self.db_org_id
+        else:
+            query = "DELETE FROM EvOccurrences"
+        self._query(query)
+
+        val_segments = []
+        for eid, dates in by_eid.items():
+            val_segments.extend(occurrenceValues(eid, dates))
+        self._insertOccurrences(val_segments)
+
+        if self.db_org_id:
+            self._invalidate()
+        else:
+            cache.clearAll()
+        return len(val_segments)
 
-    def updateEvent(self, eid, user_name, **kwa):
+    def updateEvent(self, eid, user_name, version=None, **kwa):
         """
             kwa should dereference to a dict of values
-            keyed by column
+            keyed by column.
+            version is the event's version (lastUpdated) as read
+            for editing; if given and the event has changed since,
+            raise EventConflictError rather than overwrite.
         """
 
         assert(self.db_org_id != 0)
 
+        self._updateEvent(eid, user_name, version, kwa)
+        self._invalidate()
+
+    def _updateEvent(self, eid, user_name, version, kwa):
+        query = self._updateEventQuery(eid, user_name, kwa, version)
+        if version is None:
+            self._query(query)
+            return
+        # ROW_COUNT must come from the same connection, right after
+        rows = Results(self._query('%s\0SELECT ROW_COUNT() AS n' % query))
+        if not rows[0].n:
+            raise EventConflictError(eid)
+
+    def _updateEventQuery(self, eid, user_name, kwa, version=None):
+        """
+            UPDATE statement for updateEvent. lastUpdated always
+            moves forward, even for two saves in one second, so that
+            it can serve as a version.
+        """
+
         sql_quote = self._sql_quote
         eid = int(eid)
 
@@ -637,15 +1322,20 @@ class EventDatabaseWriteProvider(object):
             if type(val) == type(u''):
                 val = encodeString(val)
             assignments.append("""%s=%s""" % (key, sql_quote(val)))
-        query = """
+        if version is None:
+            version_test = ""
+        else:
+            version_test = "AND lastUpdated=%s" % sql_quote(version)
+        return """
             UPDATE Events
-            SET %s, lastUpdator=%s
-            WHERE eid=%i AND oid=%i
+            SET %s, lastUpdator=%s,
+             lastUpdated=IF(lastUpdated >= NOW(), lastUpdated + INTERVAL 1 SECOND, NOW())
+            WHERE eid=%i AND oid=%i %s
         """ % (",\n".join(assignments),
             sql_quote(user_name),
             eid,
-            self.db_org_id)
-        self.reader.query(query)
+            self.db_org_id,
+            version_test)
 
     def lastEventInsertId(self):
         """
@@ -655,7 +1345,7 @@ class EventDatabaseWriteProvider(object):
         query = """
             select distinct last_insert_id() as liid from Events
         """
-        return Results(self.reader.query(query))[0].liid
+        return Results(self._query(query))[0].liid
 
     def eventInsert(self, member, **kwa):
         """
@@ -703,5 +1393,121 @@ class EventDatabaseWriteProvider(object):
                 sql_quote(encodeString(kwa.get('udf2', ''))),
                 sql_quote(member),
                 )
-        self.reader.query(query)
+        self._query(query)
+        self._invalidate()
         return self.lastEventInsertId()
+
+    def _storedSchedule(self, eid):
+        """
+            (set of gcids, set of (start, end, recurs)) now stored
+            for eid, in one query
+        """
+
+        query = """
+            SELECT 'c' AS kind, gcid AS a, NULL AS b, NULL AS c
+             FROM EvCats WHERE eid = %i
+            UNION ALL
+            SELECT 'd', DATE_FORMAT(sdate, "%%Y-%%m-%%d"),
+             DATE_FORMAT(edate, "%%Y-%%m-%%d"), recurs
+             FROM EvDates WHERE eid = %i
+        """ % (eid, eid)
+        gcids = set()
+        dates = set()
+        for row in Results(self._query(query)):
+            if row.kind == 'c':
+                gcids.add(int(row.a))
+            else:
+                dates.add((row.a, row.b, row.c))
+        return gcids, dates
+
+    def saveEvent(self, eid, member, gcids, dates, version=None, **kwa):
+        """
+            Save an event from the edit form: insert it if eid is 0,
+            otherwise update it, then bring its categories and dates
+            to gcids and dates (a sequence of (start, end, recurs))
+            with only the inserts and deletes needed. Statements go
+            to the database in one batch; returns the eid.
+            An update checks version as updateEvent does, before
+            anything else is written.
+        """
+
+        assert(self.db_org_id != 0)
+
+        sql_quote = self._sql_quote
+        statements = []
+        if eid:
+            eid = int(eid)
+            self._updateEvent(eid, member, version, kwa)
+            self._invalidate()
+            old_gcids, old_dates = self._storedSchedule(eid)
+        else:
+            eid = self.eventInsert(member, **kwa)
+            old_gcids, old_dates = set(), set()
+
+        new_gcids = set([int(gcid) for gcid in gcids])
+        new_dates = set()
+        for sdate, edate, recurs in dates:
+            if type(recurs) == type(u''):
+                recurs = encodeString(recurs)
+            new_dates.add((sdate.isoformat(), edate.isoformat(), recurs))
+
+        to_delete = old_gcids - new_gcids
+        if to_delete:
+            statements.append("""
+                DELETE FROM EvCats
+                WHERE eid = %i AND gcid IN (%s)
+            """ % (eid, ', '.join([str(gcid) for gcid in to_delete])))
+        to_add = new_gcids - old_gcids
+        if to_add:
+            statements.append("""
+                INSERT INTO EvCats (eid, gcid) VALUES
+                %s
+            """ % ', '.join(["(%i, %i)" % (eid, gcid) for gcid in to_add]))
+
+        for sdate, edate, recurs in old_dates - new_dates:
+            statements.append("""
+                DELETE FROM EvDates
+                WHERE eid = %i AND sdate = '%s' AND edate = '%s' AND recurs = %s
+            """ % (eid, sdate, edate, sql_quote(recurs)))
+        to_add = new_dates - old_dates
+        if to_add:
+            statements.append("""
+                INSERT INTO EvDates (eid, sdate, edate, recurs) VALUES
+                %s
+            """ % ', '.join([
+                "(%i, '%s', '%s', %s)" % (eid, sdate, edate, sql_quote(recurs))
+                for sdate, edate, recurs in to_add
+                ]))
+
+        if old_dates != new_dates and getSetting('use-occurrence-table'):
+            def days(dates):
+                rez = set()
+                for sdate, edate, recurs in dates:
+                    sdate = caldate.parseDateString(sdate)
+                    edate = caldate.parseDateString(edate)
+                    rez.update(caldate.expand(sdate, edate, sdate, recurs))
+                return rez
+            old_days = days(old_dates)
+            new_days = days(new_dates)
+            gone = old_days - new_days
+            if gone:
+                statements.append("""
+                    DELETE FROM EvOccurrences
+                    WHERE eid = %i AND date IN (%s)
+                """ % (eid, ', '.join(
+                    ["'%s'" % day.isoformat() for day in sorted(gone)])))
+            added = sorted(new_days - old_days)
+            for i in range(0, len(added), occurrence_batch):
+                statements.append("""
+                    INSERT IGNORE INTO EvOccurrences (eid, date) VALUES
+                    %s
+                """ % ', '.join([
+                    "(%i, '%s')" % (eid, day.isoformat())
+                    for day in added[i:i + occurrence_batch]
+                    ]))
+
+        if statements:
+            # the database adapter runs \0-separated statements in turn
+            self._query('\0'.join(statements))
+            self._invalidate()
+        return eid
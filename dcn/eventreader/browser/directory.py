@@ -0,0 +1,185 @@
+"""
+
+In-process snapshot of the Orgs and GlobalCategories tables
+
+Both are small and rarely written. The snapshot loads on first use,
+reloads after its TTL (so writes made through other ZEO clients show
+up), and refreshes single organizations when they're marked dirty by
+a write in this process. version goes up with every change, so other
+caches may key on it.
+
+    >>> tables = {
+    ...     'Orgs': [{'oid': 1, 'name': 'Beta'}, {'oid': 2, 'name': 'alpha'}],
+    ...     'GlobalCategories': [{'gcid': 7, 'title': 'Music', 'oid': 1}],
+    ...     }
+    >>> def query(sql):
+    ...     table = sql.split('FROM ')[1].split()[0]
+    ...     rows = tables[table]
+    ...     if 'WHERE' in sql:
+    ...         oid = int(sql.split('oid = ')[1])
+    ...         rows = [r for r in rows if r['oid'] == oid]
+    ...     return rows
+    >>> d = Directory(300)
+    >>> d.sync(query)
+    >>> [o.name for o in d.orgs()], d.cats(1)[0].title, d.catTitle(7)
+    (['alpha', 'Beta'], 'Music', 'Music')
+    >>> tables['Orgs'][0]['name'] = 'Gamma'
+    >>> version = d.version
+    >>> d.invalidate(1)
+    >>> d.sync(query)
+    >>> d.org(1).name, d.version > version
+    ('Gamma', True)
+
+fingerprint digests the contents, so it's the same in every ZEO
+client holding the same rows, and changes when they do:
+
+    >>> stamp = d.fingerprint()
+    >>> d.invalidate(1)
+    >>> d.sync(query)
+    >>> d.fingerprint() == stamp
+    True
+    >>> tables['GlobalCategories'][0]['title'] = 'Dance'
+    >>> d.invalidate(1, cats=True)
+    >>> d.sync(query)
+    >>> d.fingerprint() == stamp
+    False
+
+"""
+
+import threading
+from hashlib import md5
+from time import time
+
+
+class Record(dict):
+    """ a row that allows attribute as well as item access """
+
+    __allow_access_to_unprotected_subobjects__ = 1
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+def sortName(org):
+    # MySQL's default collation ignores case
+    return (org.get('name') or '').lower()
+
+
+class Directory(object):
+    """
+        oid -> org record, oid -> categories in title order and
+        gcid -> category title. Records are shared; don't mutate them.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.version = 0
+        self._lock = threading.RLock()
+        self._loaded = None
+        self._orgs = {}
+        self._cats = {}
+        self._titles = {}
+        self._dirty_orgs = set()
+        self._dirty_cats = set()
+        # (version, fingerprint)
+        self._fingerprint = (None, None)
+
+    def invalidate(self, oid, cats=False):
+        """ mark an organization, and maybe its categories, for refresh """
+
+        with self._lock:
+            self._dirty_orgs.add(oid)
+            if cats:
+                self._dirty_cats.add(oid)
+            self.version += 1
+
+    def sync(self, query):
+        """
+            Bring the snapshot up to date; query is a callable
+            that takes SQL and returns a sequence of row dicts.
+        """
+
+        if (self._loaded is not None and time() - self._loaded < self.ttl
+                and not self._dirty_orgs and not self._dirty_cats):
+            return
+        with self._lock:
+            if self._loaded is None or time() - self._loaded >= self.ttl:
+                self._load(query)
+                return
+            while self._dirty_orgs:
+                oid = self._dirty_orgs.pop()
+                rows = query("SELECT * FROM Orgs WHERE oid = %i" % oid)
+                if rows:
+                    self._orgs[oid] = Record(rows[0])
+                else:
+                    self._orgs.pop(oid, None)
+            while self._dirty_cats:
+                oid = self._dirty_cats.pop()
+                rows = query(
+                    "SELECT * FROM GlobalCategories WHERE oid = %i" % oid)
+                for cat in self._cats.pop(oid, []):
+                    self._titles.pop(cat['gcid'], None)
+                self._addCats(rows)
+            self.version += 1
+
+    def _addCats(self, rows):
+        changed = set()
+        for row in rows:
+            cat = Record(row)
+            self._cats.setdefault(cat['oid'], []).append(cat)
+            self._titles[cat['gcid']] = cat['title']
+            changed.add(cat['oid'])
+        for oid in changed:
+            self._cats[oid].sort(key=lambda c: (c['title'] or '').lower())
+
+    def _load(self, query):
+        orgs = dict([
+            (row['oid'], Record(row))
+            for row in query("SELECT * FROM Orgs")
+            ])
+        self._orgs = orgs
+        self._cats = {}
+        self._titles = {}
+        self._addCats(query("SELECT * FROM GlobalCategories"))
+        self._dirty_orgs.clear()
+        self._dirty_cats.clear()
+        self._loaded = time()
+        self.version += 1
+
+    def org(self, oid):
+        """ org record for oid, or None """
+
+        return self._orgs.get(oid)
+
+    def orgs(self):
+        """ all org records, in name order """
+
+        return sorted(self._orgs.values(), key=sortName)
+
+    def cats(self, oid):
+        """ category records for oid, in title order """
+
+        return self._cats.get(oid, [])
+
+    def catTitle(self, gcid):
+        return self._titles.get(gcid)
+
+    def fingerprint(self):
+        """ digest of the orgs and categories, for validators """
+
+        version, digest = self._fingerprint
+        if version == self.version:
+            return digest
+        with self._lock:
+            version = self.version
+            rows = [sorted(org.items()) for oid, org in sorted(self._orgs.items())]
+            rows.extend([
+                sorted(cat.items())
+                for oid, cats in sorted(self._cats.items()) for cat in cats
+                ])
+            digest = md5(repr(rows)).hexdigest()
+            self._fingerprint = (version, digest)
+        return digest
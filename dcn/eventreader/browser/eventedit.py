@@ -27,6 +27,7 @@ from plone.app.layout.navigation.interfaces import INavigationRoot
 
 from dbaccess import IEventDatabaseProvider, IEventDatabaseWriteProvider
 from dbaccess import decodeString
+from dbaccess import EventConflictError
 
 # from Products.CMFCore.interfaces import INavigationRoot
 from Products.statusmessages.interfaces import IStatusMessage
@@ -68,6 +69,11 @@ class IEventEditForm(form.Schema):
         required=False,
         )
 
+    version = schema.TextLine(
+        title=u"Event Version",
+        required=False,
+        )
+
     title = schema.TextLine(
         title=u"Event Title",
         description=u"Keep it short! Turn off the caps-lock.",
@@ -345,6 +351,7 @@ class EventEditForm(form.SchemaForm):
     def updateWidgets(self):
         super(EventEditForm, self).updateWidgets()
         self.widgets['eid'].mode = z3c.form.interfaces.HIDDEN_MODE
+        self.widgets['version'].mode = z3c.form.interfaces.HIDDEN_MODE
 
     def updateActions(self):
             super(EventEditForm, self).updateActions()
@@ -358,16 +365,11 @@ class EventEditForm(form.SchemaForm):
         fill and return a content object
         """
 
-        def strToDate(s):
-            yr, mo, day = s.split('-')
-            return date(int(yr), int(mo), int(day))
-
         def findRecurs(dates):
             last_delta = None
             starts = [d.start for d in dates]
-            prev = strToDate(starts[0])
-            for start in starts[1:]:
-                dt = strToDate(start)
+            prev = starts[0]
+            for dt in starts[1:]:
                 delta = dt - prev
                 if last_delta and delta != last_delta:
                     return None
@@ -395,14 +397,17 @@ class EventEditForm(form.SchemaForm):
 
         eid = self.eid
         if eid:
-            event_data = self.database.getEvent(eid)
+            bundle = self.database.getEventBundle([eid])[eid]
+            event_data = bundle['event']
             for key in EventEditForm.database_attributes:
                 value = event_data.get(key)
                 setattr(obj, key, value)
             for key in ('public', 'free', 'community'):
                 setattr(obj, key, event_data[key] == "Y")
+            # lastUpdated as read, to catch concurrent edits
+            obj.version = event_data.get('version')
 
-            cats = [c.gcid for c in self.database.getEventCats(eid)]
+            cats = bundle['cats']
             my_cats = [c.gcid for c in self.database.getOrgCats()]
             org_cats = []
             major_cats = []
@@ -414,7 +419,7 @@ class EventEditForm(form.SchemaForm):
             obj.majorCats = major_cats
             obj.orgCats = org_cats
 
-            dates = self.database.getEventDates(eid)
+            dates = bundle['dates']
 
             # check to see if this is an old-style date list
             # that happens to recur regularly
@@ -426,8 +431,8 @@ class EventEditForm(form.SchemaForm):
 
             if len(dates) == 1:
                 # simple scheduling
-                obj.start = strToDate(dates[0].start)
-                obj.end = strToDate(dates[0].end)
+                obj.start = dates[0].start
+                obj.end = dates[0].end
                 obj.recurs = dates[0].recurs
             else:
                 # we are irregularly scheduled
@@ -437,8 +442,7 @@ class EventEditForm(form.SchemaForm):
                 if len(dates):
                     wkdates = []
                     for d in dates:
-                        yr, mo, dy = d.start.split('-')
-                        wkdates.append("/".join((mo, dy, yr[2:])))
+                        wkdates.append(d.start.strftime('%m/%d/%y'))
                     obj.dates = ", ".join(wkdates)
         else:
             obj.start = date.today()
@@ -493,24 +497,27 @@ class EventEditForm(form.SchemaForm):
         for key in ('public', 'free', 'community'):
             event_data[key] = data.get(key) and "Y" or "N"
 
-        if eid:
-            writer.updateEvent(eid, member, **event_data)
-            writer.deleteEventCats(eid)
-            writer.deleteEventDates(eid)
-        else:
-            eid = writer.eventInsert(member, **event_data)
-
-        writer.evCatsInsert(eid, list(data['orgCats'].union(data['majorCats'])))
-
         if data['recurs'] == 'irregular':
             # irregular scheduling; save a list of dates
-            writer.evDatesInsert(
-                eid,
-                [(dt, dt, u"daily") for dt in form['date_list']]
-                )
+            dates = [(dt, dt, u"daily") for dt in form['date_list']]
         else:
             # regular scheduling
-            writer.evDatesInsert(eid, ((data['start'], data['end'], data['recurs']), ))
+            dates = ((data['start'], data['end'], data['recurs']), )
+
+        try:
+            eid = writer.saveEvent(
+                eid, member,
+                data['orgCats'].union(data['majorCats']),
+                dates,
+                version=data.get('version'),
+                **event_data
+                )
+        except EventConflictError:
+            self.status = (
+                u"Someone else saved this event while you were editing it. "
+                u"Cancel, then reopen the event to see their changes."
+                )
+            return
 
         messages = IStatusMessage(self.request)
         messages.add(u"Event saved", type=u"info")
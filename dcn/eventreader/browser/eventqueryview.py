@@ -1,7 +1,10 @@
 import calendar
 from datetime import date
 from datetime import timedelta
-from time import time
+from itertools import groupby, izip
+from operator import itemgetter
+from time import mktime
+import heapq
 
 from Acquisition import aq_get, aq_base
 from zope.i18nmessageid import MessageFactory
@@ -12,12 +15,19 @@ from plone.memoize.instance import memoize
 from plone.memoize import ram
 
 from Products.Five import BrowserView
+from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
 from Products.CMFCore.utils import getToolByName
 
+import cache
+import conditional
+import formatting
 import param_utils
+import timing
+from config import getSetting
 from dbaccess import IEventDatabaseProvider
 from dbaccess import decodeString
 from dbaccess import decodeStrings
+from dbaccess import org_directory
 
 import caldate
 
@@ -47,6 +57,12 @@ class IEventQueryView(Interface):
     def eventList(self):
         """ get events in a simple list, based on params """
 
+    def dateRange():
+        """ (start, end) dates of the display for the mode param """
+
+    def iterEvents(start, end, limit=None):
+        """ lazily yield (date, event) pairs in date, time order """
+
     def eventDayList(max=0):
         """ return upcoming events as list of day lists """
 
@@ -109,6 +125,9 @@ class IEventQueryView(Interface):
     def editMode():
         """ are we in edit mode? """
 
+    def gridUrl():
+        """ url of the @@calendar-grid fragment for client navigation """
+
     def orgList(self):
         """
             return a list of current organizations
@@ -124,16 +143,28 @@ def cleanDate(adate):
     return adate.strftime('%Y-%m-%d')
 
 
+# anonymous renderings of the views named in
+# EventQueryView.render_cached_views
+render_cache = cache.LRUCache(
+    getSetting('render-cache-size'),
+    getSetting('render-cache-ttl'),
+    )
+
+
 class EventQueryView(BrowserView):
     """
     EventQuery browser view
     """
     implements(IEventQueryView)
 
+    # RequestTimings when the server-timing setting is on
+    timings = None
+
     def __init__(self, context, request):
         self.editing = False
         self.context = context
         self.request = request
+        self.timings = timing.getTimings(request)
         self.database = IEventDatabaseProvider(context)
         self.portal_calendar = getToolByName(context, 'portal_calendar')
         self.portal_state = getMultiAdapter((self.context, self.request), name=u'plone_portal_state')
@@ -173,6 +204,99 @@ class EventQueryView(BrowserView):
 
         self.params = vals
 
+    # browser:page names whose anonymous output we cache
+    render_cached_views = ('calendar', 'calendar-grid')
+
+    # browser:page names that answer conditional GETs
+    conditional_views = (
+        'calendar', 'calendar-grid', 'eventsRSS', 'upcomingevents_view')
+
+    def __call__(self, *args, **kwargs):
+        if self.timings is None:
+            return self._render(*args, **kwargs)
+        try:
+            return self._render(*args, **kwargs)
+        finally:
+            timing.finish(self.request, self.timings)
+
+    @timing.timed('render')
+    def renderTemplate(self, *args, **kwargs):
+        return self.index(*args, **kwargs)
+
+    def _render(self, *args, **kwargs):
+        if getattr(self, '__name__', None) in self.conditional_views:
+            etag, last_modified = self.freshness()
+            if conditional.isNotModified(self.request, etag, last_modified):
+                return ''
+
+        if not self.renderCacheable():
+            return self.renderTemplate(*args, **kwargs)
+
+        response = self.request.response
+        key = self.renderCacheKey()
+        entry = render_cache.get(key)
+        if entry is not None:
+            html, content_type = entry
+            if content_type:
+                response.setHeader('Content-Type', content_type)
+            return html
+
+        html = self.renderTemplate(*args, **kwargs)
+        if response.getStatus() == 200:
+            render_cache.set(
+                key,
+                (html, response.getHeader('Content-Type')),
+                oids=self.db_org_list,
+                )
+        return html
+
+    def freshness(self):
+        """
+            (ETag, Last-Modified) validators: the latest event update
+            and event count for our orgs, the organizations and
+            categories, plus today's date, since the window of
+            displayed events moves daily.
+        """
+
+        lastmod, count = self.database.lastModified(self.db_org_list)
+        directory = self.database.directoryFingerprint()
+        midnight = int(mktime(self.today.timetuple()))
+        if self.portal_state.anonymous():
+            user = ''
+        else:
+            user = self.portal_state.member().getId()
+        etag = conditional.makeETag(lastmod, count, directory, self.today, user)
+        return etag, max(lastmod, midnight)
+
+    def renderCacheable(self):
+        """
+            May this rendering come from, or go to, render_cache?
+            Only anonymous views without pending status messages.
+        """
+
+        return (
+            getattr(self, '__name__', None) in self.render_cached_views
+            and not self.editing
+            and self.portal_state.anonymous()
+            and not self.request.cookies.get('statusmessages')
+            )
+
+    def renderCacheKey(self):
+        """
+            The output depends on the nav root, the consolidated
+            params and today's date. myUrl gives the nav root's URL
+            as we're seen, but leaves out filters and flags, so the
+            params go in whole.
+        """
+
+        return (
+            self.__name__,
+            self.myUrl(),
+            param_utils.paramsKey(self.params),
+            self.today,
+            self.request.get('LANGUAGE', ''),
+            )
+
     @memoize
     def getOrgData(self):
         """
@@ -192,6 +316,7 @@ class EventQueryView(BrowserView):
             start, end, self.db_org_list, **self.params
             )
 
+    @timing.timed('expand')
     def eventsByDay(self, start, end):
         """
         Returns a day-keyed dictionary of days between start and end with events.
@@ -199,22 +324,26 @@ class EventQueryView(BrowserView):
         Also, optionally, selects by several criteria
         """
         days = {}
+        if getSetting('use-occurrence-table'):
+            # recurrences already expanded, one row per date
+            query = self.database.occurrencesByDateRange(
+                start, end, self.db_org_list, **self.params
+                )
+            for result in query:
+                days.setdefault(result['date'], []).append(result)
+            return days
+
         query = self.eventsByDateRange(start, end)
         # get the dates, taking recurrence into account
-        for result in query:
-            recurs = result.get('recurs', 'daily')
-            estart = result['start']
-            ldate = min(end, result['end'])
-            if recurs == 'weekly':
-                dates = caldate.weekly(start, ldate, estart)
-            elif recurs == 'biweekly':
-                dates = caldate.biweekly(start, ldate, estart)
-            elif recurs == 'monthly':
-                dates = caldate.monthly(start, ldate, estart)
-            else:  # daily
-                dates = caldate.daily(start, ldate, estart)
-            for d in dates:
-                days.setdefault(d, []).append(result)
+        indexes, ordinals = caldate.expandRows(
+            [(r['start'], r['end'], r.get('recurs', 'daily')) for r in query],
+            start, end,
+            )
+        by_ordinal = {}
+        for i, o in izip(indexes, ordinals):
+            by_ordinal.setdefault(o, []).append(query[i])
+        for o, events in by_ordinal.iteritems():
+            days[date.fromordinal(o)] = events
 
         return days
 
@@ -303,22 +432,26 @@ class EventQueryView(BrowserView):
         else:
             return self.getEventMonth(target)
 
-    @memoize
-    def eventList(self):
-        """ get events in a simple list, based on params.
-            list format [(date, eventdict),...] """
+    def dateRange(self):
+        """ (start, end) dates of the display for the mode param """
 
         target = self.params.get('date', self.today)
         mode = self.params.get('mode', 'month')
         if mode == 'day':
-            edict = self.eventsByDay(target, target)
+            return target, target
         elif mode == 'week':
-            edict = self.eventsByDay(caldate.startOfWeek(target), caldate.endOfWeek(target))
+            return caldate.startOfWeek(target), caldate.endOfWeek(target)
         elif mode == 'upcoming':
-            end = self.today + timedelta(self.params.get('days', 30))
-            edict = self.eventsByDay(self.today, end)
+            return self.today, self.today + timedelta(self.params.get('days', 30))
         else:
-            edict = self.eventsByDay(caldate.startOfMonth(target), caldate.endOfMonth(target))
+            return caldate.startOfMonth(target), caldate.endOfMonth(target)
+
+    @memoize
+    def eventList(self):
+        """ get events in a simple list, based on params.
+            list format [(date, eventdict),...] """
+
+        edict = self.eventsByDay(*self.dateRange())
         keys = edict.keys()
         keys.sort()
         elist = []
@@ -326,34 +459,65 @@ class EventQueryView(BrowserView):
             elist.append([key, edict[key]])
         return elist
 
+    def iterEvents(self, start, end, limit=None):
+        """
+        Lazily yields (date, event) pairs between start and end,
+        in date and starting time order. limit is a hint that the
+        caller will stop after about that many events; whole days
+        are still yielded.
+        """
+
+        if getSetting('use-occurrence-table'):
+            query = self.database.occurrencesByDateRange(
+                start, end, self.db_org_list, limit=limit, **self.params
+                )
+            if limit and len(query) >= limit:
+                # the limit may have cut the last day short; finish it
+                last = query[-1]['date']
+                query = [r for r in query if r['date'] != last] + list(
+                    self.database.occurrencesByDateRange(
+                        last, last, self.db_org_list, **self.params
+                        )
+                    )
+            for result in query:
+                yield result['date'], result
+            return
+
+        query = self.eventsByDateRange(start, end)
+
+        def occurrences(i, result):
+            # sort key, then the row index as tie-breaker; a NULL
+            # time doesn't compare with a time, so use seconds
+            stime = formatting.timeKey(result.get('startTime'))
+            title = result['title']
+            for o in caldate.occurrenceOrdinals(
+                    start, min(end, result['end']), result['start'],
+                    result.get('recurs', 'daily')):
+                yield o, stime, title, i
+
+        streams = [occurrences(i, result) for i, result in enumerate(query)]
+        fromordinal = date.fromordinal
+        for o, stime, title, i in heapq.merge(*streams):
+            yield fromordinal(o), query[i]
+
     def eventDayList(self, max=0):
         """ return upcoming events as list of day lists.
             Format is [[date, [eventdict,...]]...] """
 
-        def mediumFormatDate(d):
-            return d.strftime("%A, %x")
-
         self.params['mode'] = 'upcoming'
-        events = self.eventList()
-        day = []
+        end = self.today + timedelta(self.params.get('days', 30))
         rez = []
-        last_date = date(1900, 1, 1)
         found = 0
-        for e in events:
-            sdate = e[0]
-            if sdate != last_date:
-                if day:
-                    rez.append([mediumFormatDate(last_date), day])
-                    day = []
-                last_date = sdate
-            day += e[1]
-            found += len(day)
+        # whole days, until we have at least max events
+        for day, pairs in groupby(self.iterEvents(self.today, end, max), itemgetter(0)):
+            events = [e for d, e in pairs]
+            rez.append([formatting.mediumDate(day), events])
+            found += len(events)
             if found >= max:
                 break
-        if day:
-            rez.append([mediumFormatDate(last_date), day])
         return rez
 
+    @timing.timed('urls')
     def myUrl(self, **overrides):
         """
             Assemble a URL that will reproduce the
@@ -409,7 +573,17 @@ class EventQueryView(BrowserView):
 
         if s:
             s = "?%s" % s
-        return "%s%s" % (self.context_state.current_base_url(), s)
+        return "%s%s" % (self.baseUrl(), s)
+
+    def baseUrl(self):
+        """ url of this calendar page, less the query """
+
+        return self.context_state.current_base_url()
+
+    def gridUrl(self):
+        """ url of the @@calendar-grid fragment for client navigation """
+
+        return "%s/calendar-grid" % self.context.absolute_url()
 
     def monthUrl(self):
         """ url for month-mode calendar """
@@ -466,6 +640,7 @@ class EventQueryView(BrowserView):
 
         return self.params.get('date', self.today).strftime("%B %d, %Y").replace(' 0', ' ')
 
+    @timing.timed('urls')
     def getCats(self, oid=0, include_all=True):
         """ return a list of categories in alpha order unless suppressed """
 
@@ -541,7 +716,8 @@ class EventQueryView(BrowserView):
 
         return self.editing
 
-    @ram.cache(lambda *args: time() // 300)
+    @ram.cache(lambda method, self: (
+        self.context_state.current_base_url(), org_directory.version))
     def orgList(self):
         """
             return a list of current organizations
@@ -604,3 +780,18 @@ class EventEditQueryView(EventQueryView):
         """ base url to display individual events """
 
         return "%s/event-edit?eid=" % self.portal_state.navigation_root_url()
+
+
+class CalendarGridView(EventQueryView):
+    """
+    Just the navigation and table of @@calendar, without main_template;
+    main.js swaps it in for prev/next/mode clicks.
+    """
+    implements(IEventQueryView)
+
+    calendar_template = ViewPageTemplateFile('eventqueryview.pt')
+
+    def baseUrl(self):
+        """ links in the fragment lead to the full page """
+
+        return "%s/calendar" % self.context.absolute_url()
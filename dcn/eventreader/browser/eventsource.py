@@ -0,0 +1,232 @@
+"""
+
+One stream of event occurrences from several sources
+
+An IEventSource yields EventOccurrence records for a date range, in
+(date, start time) order. Sources are named multi-adapters of
+(context, request), so other packages can add their own; this one
+registers "sql" (the calendar database, through EventQueryView) and
+"catalog" (Plone Event content, through RCalendar). mergeOccurrences
+heap-merges the sources' streams, so a page showing both makes one
+pass over already-sorted data.
+
+    >>> a = [EventOccurrence(date(2012, 6, d), None, u'a%i' % d) for d in (1, 3)]
+    >>> b = [EventOccurrence(date(2012, 6, 2), time(9, 0), u'b')]
+    >>> [o.title for o in mergeOccurrences([iter(a), iter(b)])]
+    [u'a1', u'b', u'a3']
+
+"""
+
+import heapq
+from datetime import date, time, timedelta
+from itertools import groupby
+
+from DateTime import DateTime
+from zope.component import getAdapters, getMultiAdapter
+from zope.interface import implements, Interface
+
+from plone.memoize.instance import memoize
+
+from Products.Five import BrowserView
+from Products.CMFPlone.utils import safe_unicode
+
+import formatting
+import param_utils
+from rcalendar import RCalendar
+
+
+class IEventSource(Interface):
+    """
+    A source of event occurrences
+    """
+
+    def occurrences(start, end, limit=None):
+        """ EventOccurrences from start to end (dates), in key order;
+            limit is a hint, as for EventQueryView.iterEvents """
+
+
+midnight = time(0, 0)
+
+
+class EventOccurrence(object):
+    """
+        One day's occurrence of an event, whatever its source.
+        begins is None for all-day events; item is the source's
+        own record (an EventRecord, a catalog brain, ...).
+    """
+
+    __slots__ = ('key', 'date', 'begins', 'ends', 'title', 'url',
+        'acronym', 'location', 'source', 'item')
+
+    __allow_access_to_unprotected_subobjects__ = 1
+
+    def __init__(self, day, begins, title, ends=None, url=None,
+            acronym=None, location=None, source=None, item=None):
+        if begins is None:
+            seconds = -1
+        else:
+            seconds = begins.hour * 3600 + begins.minute * 60
+        self.key = (day.toordinal(), seconds)
+        self.date = day
+        self.begins = begins
+        self.ends = ends
+        self.title = title
+        self.url = url
+        self.acronym = acronym
+        self.location = location
+        self.source = source
+        self.item = item
+
+    def timeLabel(self):
+        """ 7:30pm, or '' for all-day events """
+
+        return formatting.timeLabel(self.begins) or ''
+
+    def __getitem__(self, key):
+        # for path expressions
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __repr__(self):
+        return '<EventOccurrence %s %r>' % (self.date, self.title)
+
+
+def _decorate(i, stream):
+    # source index breaks ties, keeping merge order stable
+    for occ in stream:
+        yield occ.key, i, occ
+
+
+def mergeOccurrences(streams):
+    """ merge EventOccurrence streams, each in key order, into one """
+
+    for key, i, occ in heapq.merge(*[
+            _decorate(i, stream) for i, stream in enumerate(streams)]):
+        yield occ
+
+
+def getSources(context, request, names=None):
+    """ [(name, IEventSource)] for context, in name order; all, or names """
+
+    rez = [
+        (name, source)
+        for name, source in getAdapters((context, request), IEventSource)
+        if names is None or name in names
+        ]
+    rez.sort()
+    return rez
+
+
+class SQLEventSource(object):
+    """
+        Calendar database events, with the calendar's params
+        from the request and navigation root
+    """
+
+    implements(IEventSource)
+
+    def __init__(self, context, request):
+        self.context = context
+        self.request = request
+
+    def occurrences(self, start, end, limit=None):
+        view = getMultiAdapter(
+            (self.context, self.request), name=u'eventquery_view')
+        base_url = view.showEventUrl()
+        for day, event in view.iterEvents(start, end, limit):
+            begins = event.get('startTime')
+            ends = event.get('endTime')
+            if begins == midnight and ends in (None, midnight):
+                begins = ends = None
+            yield EventOccurrence(
+                day, begins, event['title'],
+                ends=ends,
+                url="%s%s" % (base_url, event['eid']),
+                acronym=event.get('acronym'),
+                location=event.get('location'),
+                source='sql',
+                item=event,
+                )
+
+
+class CatalogEventSource(object):
+    """
+        Plone event content from portal_catalog, as RCalendar finds it
+    """
+
+    implements(IEventSource)
+
+    def __init__(self, context, request):
+        self.context = context
+        self.request = request
+
+    def occurrences(self, start, end, limit=None):
+        calendar = RCalendar(self.context, self.request)
+        occurrences = calendar.getevents(
+            DateTime(start.year, start.month, start.day),
+            DateTime(end.year, end.month, end.day),
+            )
+        for occ in occurrences:
+            ordinal, hour, minute = occ.key
+            result = occ.result
+            if hour or minute:
+                begins = time(hour, minute)
+                ends = time(result.end.hour(), result.end.minute())
+            else:
+                begins = ends = None
+            yield EventOccurrence(
+                date.fromordinal(ordinal), begins,
+                safe_unicode(result.Title or result.getId),
+                ends=ends,
+                url=result.getURL(),
+                location=safe_unicode(getattr(result, 'location', None) or ''),
+                source='catalog',
+                item=result,
+                )
+
+
+class CombinedEventsView(BrowserView):
+    """
+        Upcoming events from all sources, or some, merged
+    """
+
+    @memoize
+    def occurrences(self, start, end, limit=None, sources=None):
+        """ merged EventOccurrences from start to end """
+
+        streams = [
+            source.occurrences(start, end, limit)
+            for name, source in getSources(self.context, self.request, sources)
+            ]
+        return list(mergeOccurrences(streams))
+
+    def days(self, default=30):
+        """ days ahead to show: the days param, from the request
+            or, winning, the nav root, as EventQueryView reads it """
+
+        portal_state = getMultiAdapter(
+            (self.context, self.request), name=u'plone_portal_state')
+        params = param_utils.consolidateParams(
+            param_utils.getQueryParams(self.request),
+            param_utils.getSiteParams(portal_state.navigation_root()),
+            )
+        return params.get('days', default)
+
+    def eventDayList(self, max=0, days=30, sources=None):
+        """ upcoming occurrences as [[date string, [occurrence, ...]], ...];
+            whole days, until there are at least max occurrences """
+
+        today = date.today()
+        end = today + timedelta(self.days(days))
+        rez = []
+        found = 0
+        occurrences = self.occurrences(today, end, max or None, sources)
+        for day, occs in groupby(occurrences, lambda occ: occ.date):
+            occs = list(occs)
+            rez.append([formatting.mediumDate(day), occs])
+            found += len(occs)
+            if max and found >= max:
+                break
+        return rez
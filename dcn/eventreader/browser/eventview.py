@@ -5,41 +5,41 @@ from zope.interface import implements, Interface
 from zope.component import getMultiAdapter
 from Shared.DC.ZRDB.Results import Results
 
+from plone.memoize.instance import memoize
+
 from Products.Five import BrowserView
 
-from DateTime import DateTime
+from datetime import date
 
+import conditional
+import formatting
 import param_utils
 from dbaccess import IEventDatabaseProvider
 
 # from Products.CMFCore.utils import getToolByName
 
 
-def dtToStr(dt):
-    parts = dt.parts()
-    return "%i/%i/%i" % (parts[1], parts[2], parts[0] % 1000)
-
-
 def getEventDateRep(dates):
     """ create a string representation list of the dates associated with the
         event. consolidate ranges.
     """
 
+    dtToStr = formatting.shortDate
     res = []
     in_series = False
-    last_date = DateTime('1/1/1900')
+    last_date = date(1900, 1, 1)
     s = u''
     for item in dates:
-        if item.sdate == item.edate:
-            if item.sdate - last_date <= 1:
+        if item.start == item.end:
+            if (item.start - last_date).days <= 1:
                 in_series = True
             else:
                 if in_series:
                     s = u"%s–%s" % (s, dtToStr(last_date))
                     in_series = False
                 # else:
-                #     s = dtToStr(item.sdate)
-                s = u"%s%s%s" % (s, s and ', ' or '', dtToStr(item.sdate))
+                #     s = dtToStr(item.start)
+                s = u"%s%s%s" % (s, s and ', ' or '', dtToStr(item.start))
         else:
             if in_series:
                 s = u"%s-%s" % (s, dtToStr(last_date))
@@ -49,12 +49,12 @@ def getEventDateRep(dates):
                 s = u''
             res.append(
                 u"%s %s until %s" % (
-                    dtToStr(item.sdate),
+                    dtToStr(item.start),
                     item.recurs,
-                    dtToStr(item.edate)
+                    dtToStr(item.end)
                     )
                 )
-        last_date = item.sdate
+        last_date = item.start
 
     if in_series:
         s = "%s-%s" % (s, dtToStr(last_date))
@@ -105,17 +105,37 @@ class EventView(BrowserView):
         self.params = param_utils.getQueryParams(request)
         self.eid = self.params['eid']
 
+    def __call__(self, *args, **kwargs):
+        lastmod = self.database.eventLastModified(self.eid)
+        if lastmod is not None:
+            if self.portal_state.anonymous():
+                user = ''
+            else:
+                user = self.portal_state.member().getId()
+            # the page shows the event's org and category titles
+            etag = conditional.makeETag(
+                self.eid, lastmod, self.database.directoryFingerprint(), user)
+            if conditional.isNotModified(self.request, etag, lastmod):
+                return ''
+        return self.index(*args, **kwargs)
+
+    @memoize
+    def getBundle(self):
+        """ the event, its dates and org, in one trip """
+
+        return self.database.getEventBundle([self.eid]).get(self.eid, {})
+
     def getEvent(self):
         """ find an event by eid """
 
-        return self.database.getEvent(self.eid)
+        return self.getBundle().get('event')
 
     def getEventDates(self):
         """
             Return a display list of dates.
         """
 
-        return getEventDateRep(self.database.getEventDates(self.eid))
+        return getEventDateRep(self.getBundle().get('dates', []))
 
     def displayTime(self, event):
         """ start/end time for display; None if all-day """
@@ -140,6 +160,9 @@ class EventView(BrowserView):
     def getOrg(self, oid):
         """ return a dict for the organization """
 
+        bundle = self.getBundle()
+        if bundle and bundle['event']['oid'] == oid:
+            return bundle['org']
         return self.database.getOrgData(oid)
 
     def getParams(self):
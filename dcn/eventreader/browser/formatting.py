@@ -0,0 +1,104 @@
+"""
+
+Display formatting for event dates and times
+
+The database hands back dates as day ordinals (TO_DAYS - 365) and
+times as seconds since midnight (TIME_TO_SEC); everything meant for
+display is formatted here. There are only 1440 minutes in a day and
+a few thousand dates in play, so results are cached.
+
+    >>> secondsToTime(70200), ordinalToDate(734655)
+    (datetime.time(19, 30), datetime.date(2012, 6, 1))
+    >>> timeLabel(time(19, 30)), timeLabel(time(0, 0))
+    (u'7:30pm', u'12:00am')
+    >>> timeDisplay(time(9, 5)), timeDisplay(time(12, 0))
+    (u'9:05 AM', u'12:00 PM')
+    >>> shortDate(date(2012, 6, 1)), shortDate(date(2009, 11, 30))
+    (u'6/1/12', u'11/30/9')
+
+Times may be NULL; timeKey sorts those first, as MySQL does:
+
+    >>> sorted([time(9, 0), None, time(0, 0)], key=timeKey)
+    [None, datetime.time(0, 0), datetime.time(9, 0)]
+
+"""
+
+from datetime import date, time
+
+# MySQL's TO_DAYS counts from year 0; Python ordinals from year 1
+to_days_offset = 365
+
+_times = {}
+_labels = {}
+_displays = {}
+_medium_dates = {}
+
+
+def secondsToTime(val):
+    """ time from seconds since midnight; other values unchanged """
+
+    if type(val) in (int, long):
+        rez = _times.get(val)
+        if rez is None:
+            rez = _times[val] = time(val // 3600, val % 3600 // 60)
+        return rez
+    return val
+
+
+def ordinalToDate(val):
+    """ date from a day ordinal; other values unchanged """
+
+    if type(val) in (int, long):
+        return date.fromordinal(val)
+    return val
+
+
+def timeKey(t):
+    """ sort key for a time or None: seconds since midnight, or -1 """
+
+    if t is None:
+        return -1
+    return t.hour * 3600 + t.minute * 60 + t.second
+
+
+def _clock(t):
+    hour = t.hour % 12 or 12
+    return hour, t.minute, t.hour < 12 and 'am' or 'pm'
+
+
+def timeLabel(t):
+    """ compact calendar form: 7:30pm; None for None """
+
+    if t is None:
+        return None
+    rez = _labels.get(t)
+    if rez is None:
+        rez = _labels[t] = u"%i:%02i%s" % _clock(t)
+    return rez
+
+
+def timeDisplay(t):
+    """ event page and edit form form: 7:30 PM; None for None """
+
+    if t is None:
+        return None
+    rez = _displays.get(t)
+    if rez is None:
+        hour, minute, ampm = _clock(t)
+        rez = _displays[t] = u"%i:%02i %s" % (hour, minute, ampm.upper())
+    return rez
+
+
+def shortDate(adate):
+    """ m/d/y, with the year mod 1000 """
+
+    return u"%i/%i/%i" % (adate.month, adate.day, adate.year % 1000)
+
+
+def mediumDate(adate):
+    """ weekday and locale date, for upcoming lists """
+
+    rez = _medium_dates.get(adate)
+    if rez is None:
+        rez = _medium_dates[adate] = adate.strftime("%A, %x")
+    return rez
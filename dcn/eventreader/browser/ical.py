@@ -0,0 +1,227 @@
+"""
+
+iCalendar (RFC 5545) feed
+
+One VEVENT per event. Regular recurrences go out as RRULEs, so
+calendar clients expand them; irregular date lists as RDATEs.
+
+"""
+
+from collections import OrderedDict
+from datetime import date, datetime, time, timedelta
+from urlparse import urlparse
+
+from Products.CMFPlone.utils import safe_unicode
+
+import caldate
+import conditional
+from eventqueryview import EventQueryView
+
+
+# ical weekday codes by date.weekday()
+weekday_codes = ('MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU')
+
+midnight = time(0, 0)
+
+# write to the response in chunks of about this many bytes
+chunk_size = 8192
+
+
+def escapeText(val):
+    """
+        Escape an iCalendar TEXT value
+
+        >>> escapeText(u'Potluck; bring a dish, or two\\nThanks')
+        u'Potluck\\\\; bring a dish\\\\, or two\\\\nThanks'
+    """
+
+    if not val:
+        return u''
+    return val.replace(u'\\', u'\\\\').replace(u';', u'\\;').replace(
+        u',', u'\\,').replace(u'\r\n', u'\\n').replace(u'\n', u'\\n')
+
+
+def foldLine(line):
+    """
+        UTF-8 encode a content line, folding it at 75 octets
+        without splitting a character
+
+        >>> foldLine(u'DESCRIPTION:' + u'x' * 70)
+        'DESCRIPTION:xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx\\r\\n xxxxxxx\\r\\n'
+    """
+
+    encoded = line.encode('utf-8')
+    if len(encoded) <= 75:
+        return encoded + '\r\n'
+    parts = []
+    limit = 75
+    while encoded:
+        cut = min(limit, len(encoded))
+        # back up over UTF-8 continuation bytes
+        while cut < len(encoded) and (ord(encoded[cut]) & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(encoded[:cut])
+        encoded = encoded[cut:]
+        # continuation lines start with a space
+        limit = 74
+    return '\r\n '.join(parts) + '\r\n'
+
+
+def icalDate(adate):
+    return adate.strftime('%Y%m%d')
+
+
+def icalDateTime(adate, hour, minute):
+    return '%sT%02d%02d00' % (icalDate(adate), hour, minute)
+
+
+def recurrenceRule(first, last, recurs):
+    """
+        RRULE value, less UNTIL, for an EvDates row first held
+        on first and ending by last; None if it doesn't recur.
+        Monthly follows caldate.monthly's week-of-month rule.
+
+        >>> recurrenceRule(date(2009, 5, 12), date(2009, 7, 31), 'monthly')
+        'FREQ=MONTHLY;BYDAY=2TU'
+        >>> [recurrenceRule(date(2009, 5, d), date(2009, 7, 31), 'monthly')
+        ...     for d in (7, 14, 21, 28)]
+        ['FREQ=MONTHLY;BYDAY=1TH', 'FREQ=MONTHLY;BYDAY=2TH', 'FREQ=MONTHLY;BYDAY=3TH', 'FREQ=MONTHLY;BYDAY=4TH']
+        >>> recurrenceRule(date(2009, 5, 12), date(2009, 7, 31), 'biweekly')
+        'FREQ=WEEKLY;INTERVAL=2'
+        >>> recurrenceRule(date(2009, 5, 12), date(2009, 5, 12), 'daily') is None
+        True
+    """
+
+    if recurs == 'weekly':
+        return 'FREQ=WEEKLY'
+    elif recurs == 'biweekly':
+        return 'FREQ=WEEKLY;INTERVAL=2'
+    elif recurs == 'monthly':
+        return 'FREQ=MONTHLY;BYDAY=%i%s' % (
+            (first.day - 1) // 7 + 1, weekday_codes[first.weekday()])
+    elif first < last:
+        return 'FREQ=DAILY'
+    return None
+
+
+class ICalView(EventQueryView):
+    """
+        @@events.ics: events for the consolidated params, from the
+        start of the displayed month through 'days' (default 365)
+        days later.
+    """
+
+    def __call__(self):
+        etag, last_modified = self.freshness()
+        if conditional.isNotModified(self.request, etag, last_modified):
+            return ''
+
+        response = self.request.response
+        response.setHeader('Content-Type', 'text/calendar; charset=utf-8')
+        response.setHeader(
+            'Content-Disposition', 'inline; filename="events.ics"')
+        buf = []
+        size = 0
+        for line in self.iterCalendar():
+            buf.append(line)
+            size += len(line)
+            if size >= chunk_size:
+                response.write(''.join(buf))
+                buf = []
+                size = 0
+        if buf:
+            response.write(''.join(buf))
+        return ''
+
+    def iterCalendar(self):
+        """ yield folded, encoded content lines """
+
+        start = caldate.startOfMonth(self.params.get('date', self.today))
+        end = start + timedelta(self.params.get('days', 365))
+
+        # rows are per EvDates entry; gather them by event
+        events = OrderedDict()
+        for result in self.eventsByDateRange(start, end):
+            events.setdefault(result['eid'], []).append(result)
+
+        yield foldLine(u'BEGIN:VCALENDAR')
+        yield foldLine(u'VERSION:2.0')
+        yield foldLine(u'PRODID:-//DCN//dcn.eventreader//EN')
+        yield foldLine(u'CALSCALE:GREGORIAN')
+        # Plone 4 titles are utf-8 strs
+        yield foldLine(u'X-WR-CALNAME:%s' % escapeText(
+            safe_unicode(self.portal_state.navigation_root_title())))
+
+        host = urlparse(self.request.get('SERVER_URL', '')).netloc or 'localhost'
+        stamp = datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+        event_base = self.showEventUrl()
+        for eid, rows in events.iteritems():
+            for line in self.vevent(eid, rows, host, stamp, event_base):
+                yield foldLine(line)
+
+        yield foldLine(u'END:VCALENDAR')
+
+    def vevent(self, eid, rows, host, stamp, event_base):
+        """ content lines for one event """
+
+        result = rows[0]
+        if len(rows) == 1:
+            ordinals = caldate.occurrenceOrdinals(
+                result['start'], result['end'], result['start'],
+                result.get('recurs', 'daily'))
+            first = next(iter(ordinals), None)
+            if first is None:
+                return
+            first = date.fromordinal(first)
+            rule = recurrenceRule(
+                first, result['end'], result.get('recurs', 'daily'))
+            others = []
+        else:
+            # irregular: every date goes out
+            ordinals = set()
+            for row in rows:
+                ordinals.update(caldate.occurrenceOrdinals(
+                    row['start'], row['end'], row['start'],
+                    row.get('recurs', 'daily')))
+            if not ordinals:
+                return
+            ordinals = sorted(ordinals)
+            first = date.fromordinal(ordinals[0])
+            rule = None
+            others = [date.fromordinal(o) for o in ordinals[1:]]
+
+        begins = result['startTime']
+        ends = result['endTime']
+        all_day = begins == ends == midnight
+
+        yield u'BEGIN:VEVENT'
+        yield u'UID:event-%i@%s' % (eid, host)
+        yield u'DTSTAMP:%s' % stamp
+        if all_day:
+            yield u'DTSTART;VALUE=DATE:%s' % icalDate(first)
+            yield u'DTEND;VALUE=DATE:%s' % icalDate(first + caldate.aday)
+            if others:
+                yield u'RDATE;VALUE=DATE:%s' % u','.join(
+                    [icalDate(d) for d in others])
+        else:
+            hour, minute = begins.hour, begins.minute
+            yield u'DTSTART:%s' % icalDateTime(first, hour, minute)
+            if ends is not None and ends > begins:
+                yield u'DTEND:%s' % icalDateTime(first, ends.hour, ends.minute)
+            if others:
+                yield u'RDATE:%s' % u','.join(
+                    [icalDateTime(d, hour, minute) for d in others])
+        if rule:
+            # UNTIL takes DTSTART's form: a date or a floating date-time
+            if all_day:
+                until = icalDate(result['end'])
+            else:
+                until = icalDateTime(result['end'], 23, 59)
+            yield u'RRULE:%s;UNTIL=%s' % (rule, until)
+        yield u'SUMMARY:%s' % escapeText(result['title'])
+        if result.get('description'):
+            yield u'DESCRIPTION:%s' % escapeText(result['description'])
+        if result.get('location'):
+            yield u'LOCATION:%s' % escapeText(result['location'])
+        yield u'URL:%s%i' % (event_base, eid)
+        yield u'END:VEVENT'
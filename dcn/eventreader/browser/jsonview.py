@@ -0,0 +1,162 @@
+"""
+
+Calendar data as JSON
+
+@@calendar.json takes the same query params as @@calendar. The
+payload is
+
+    {"start": "2012-06-01", "end": "2012-06-30",
+     "fields": ["date", "eid", "begins", "ends", "title", "acronym"],
+     "occurrences": [["2012-06-01", 12, "7:30pm", "9:00pm", "Potluck", "DCN"],
+                     ...],
+     "events": {"12": {"description": ..., "location": ..., ...}, ...},
+     "next": "2012-06-14.3"}
+
+Occurrences are compact arrays in "fields" order; everything else
+about an event is sent once, in "events". When there are more than
+"limit" occurrences, "next" is a cursor: pass it back as the
+cursor param to get the following page. It is null on the last page.
+
+"""
+
+import json
+
+import caldate
+import conditional
+from eventqueryview import EventQueryView
+
+
+occurrence_fields = ('date', 'eid', 'begins', 'ends', 'title', 'acronym')
+
+# per-event attributes that don't travel with each occurrence
+event_fields = ('description', 'location', 'eventUrl', 'orgname', 'url')
+
+default_limit = 500
+max_limit = 2000
+
+# write to the response in chunks of about this many bytes
+chunk_size = 8192
+
+
+def parseCursor(val):
+    """
+        (date, skip) from a cursor param, or None
+
+        >>> parseCursor('2012-06-14.3')
+        (datetime.date(2012, 6, 14), 3)
+        >>> parseCursor('2012-06-14') is None, parseCursor('bogus.1') is None
+        (True, True)
+    """
+
+    try:
+        day, skip = val.split('.')
+        return caldate.parseDateString(day), max(int(skip), 0)
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def makeCursor(day, skip):
+    return '%s.%i' % (day.isoformat(), skip)
+
+
+class CalendarJSONView(EventQueryView):
+    """
+        @@calendar.json: the occurrences @@calendar would display,
+        for machine clients.
+    """
+
+    def __call__(self):
+        etag, last_modified = self.freshness()
+        if conditional.isNotModified(self.request, etag, last_modified):
+            return ''
+
+        response = self.request.response
+        response.setHeader('Content-Type', 'application/json; charset=utf-8')
+        buf = []
+        size = 0
+        for part in self.iterJSON():
+            buf.append(part)
+            size += len(part)
+            if size >= chunk_size:
+                response.write(''.join(buf))
+                buf = []
+                size = 0
+        if buf:
+            response.write(''.join(buf))
+        return ''
+
+    def pageLimit(self):
+        try:
+            limit = int(self.request.form.get('limit', default_limit))
+        except (TypeError, ValueError):
+            limit = default_limit
+        return min(max(limit, 1), max_limit)
+
+    def iterPage(self):
+        """
+            (start, end, pairs, state) for the requested page; pairs
+            is a generator of (date, event). Once it is exhausted,
+            state['next'] is the cursor for the following page, or None.
+        """
+
+        start, end = self.dateRange()
+        limit = self.pageLimit()
+        cursor = parseCursor(self.request.form.get('cursor'))
+        skip = 0
+        if cursor is not None and start <= cursor[0] <= end:
+            start, skip = cursor
+        page_start = start
+        state = {'next': None}
+
+        def pairs():
+            events = self.iterEvents(page_start, end, skip + limit + 1)
+            # occurrences on the cursor day that earlier pages sent
+            for i in xrange(skip):
+                if next(events, None) is None:
+                    return
+            # count of occurrences sent so far on the current day
+            day, on_day = page_start, skip
+            sent = 0
+            for d, event in events:
+                if d != day:
+                    day, on_day = d, 0
+                if sent == limit:
+                    state['next'] = makeCursor(day, on_day)
+                    return
+                yield d, event
+                sent += 1
+                on_day += 1
+
+        return page_start, end, pairs(), state
+
+    def iterJSON(self):
+        """ yield the payload in encoded pieces """
+
+        start, end, pairs, state = self.iterPage()
+        dumps = json.dumps
+        event_base = self.showEventUrl()
+
+        yield '{"start": %s, "end": %s, "fields": %s, "occurrences": [' % (
+            dumps(start.isoformat()),
+            dumps(end.isoformat()),
+            dumps(occurrence_fields),
+            )
+        events = {}
+        sep = ''
+        for day, event in pairs:
+            eid = event['eid']
+            yield sep + dumps([
+                day.isoformat(), eid, event['begins'], event['ends'],
+                event['title'], event.get('acronym'),
+                ])
+            sep = ', '
+            if eid not in events:
+                details = dict([(k, event.get(k)) for k in event_fields])
+                details['link'] = '%s%i' % (event_base, eid)
+                events[eid] = details
+        yield '], "events": {'
+        sep = ''
+        for eid, details in events.iteritems():
+            yield '%s"%i": %s' % (sep, eid, dumps(details))
+            sep = ', '
+        yield '}, "next": %s}' % dumps(state['next'])
@@ -0,0 +1,50 @@
+"""
+
+Database maintenance views
+
+"""
+
+from zope.component import getMultiAdapter
+
+from Products.Five import BrowserView
+
+from dbaccess import IEventDatabaseWriteProvider
+from dbaccess import connection_pool
+from replicas import replica_set
+
+
+class RebuildOccurrencesView(BrowserView):
+    """
+        Backfill or rebuild the EvOccurrences table from EvDates.
+        At the site root this rebuilds every organization.
+    """
+
+    def __call__(self):
+        portal_state = getMultiAdapter(
+            (self.context, self.request),
+            name=u'plone_portal_state'
+            )
+        navigation_root = portal_state.navigation_root()
+        writer = IEventDatabaseWriteProvider(navigation_root)
+        count = writer.rebuildOccurrences()
+        self.request.response.setHeader('Content-Type', 'text/plain')
+        return "Wrote %i occurrences.\n" % count
+
+
+class PoolStatsView(BrowserView):
+    """
+        Connection pool and read replica statistics for this
+        ZEO client, as text
+    """
+
+    def __call__(self):
+        stats = connection_pool.stats()
+        lines = ["%s: %s\n" % (key, stats[key]) for key in sorted(stats)]
+        for name, health in sorted(replica_set.stats().items()):
+            lines.append(
+                "replica %s: %s\n" % (name, ', '.join(
+                    ["%s %s" % (key, health[key]) for key in sorted(health)]
+                    ))
+                )
+        self.request.response.setHeader('Content-Type', 'text/plain')
+        return ''.join(lines)
@@ -1,5 +1,20 @@
 # utilities for collecting and sanitizingparameters
 # from request and nav root
+"""
+Every calendar param changes paramsKey:
+
+    >>> samples = {'mode': 'week', 'date': '2012-6-1', 'org': '3,4',
+    ...     'gcid': '7', 'public': 'y', 'free': 'n', 'common': 'y',
+    ...     'udf1': 'y', 'udf2': 'n', 'days': '10', 'eid': '5',
+    ...     'public-show': 'y', 'free-show': 'n', 'nocat-display': '1'}
+    >>> sorted(samples) == sorted(cal_params)
+    True
+    >>> [key for key in sorted(samples)
+    ...     if paramsKey(sanitizeParamDict({key: samples[key]})) == paramsKey({})]
+    []
+    >>> paramsKey(sanitizeParamDict({'free': 'Y', 'org': '3,4'}))
+    (('free', 'y'), ('org', (3, 4)))
+"""
 
 import caldate
 
@@ -73,6 +88,15 @@ def sanitizeParamDict(params):
     return params
 
 
+def paramsKey(params):
+    """ sanitized params as a hashable, order-independent key """
+
+    return tuple(sorted([
+        (key, type(val) == list and tuple(val) or val)
+        for key, val in params.items()
+        ]))
+
+
 def getQueryParams(request):
     """ Examine the HTTP query and pick up params for cal display """
 
@@ -105,3 +129,8 @@ def consolidateParams(vals, svals):
     for key in svals:
         vals[key] = svals[key]
     return vals
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
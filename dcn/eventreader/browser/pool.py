@@ -0,0 +1,265 @@
+"""
+
+Database connection pool
+
+Zope database adapters keep a connection per ZODB connection, and so
+in practice per thread, and queries made through it join the Zope
+transaction. The pool hands out those connections rather than opening
+its own. It adds what the adapters lack: a ping after idle periods,
+with a reconnect if the server has dropped us; closing connections
+left idle too long; and usage statistics for sizing against the
+ZServer thread count.
+
+Worker threads that query on a request's behalf can't share its
+connection; dedicated() opens them their own, from an adapterSpec
+taken in the request's thread, and keeps it for the thread's next
+call.
+
+"""
+
+import threading
+from thread import get_ident
+from time import time
+
+from Acquisition import aq_base
+
+
+stat_names = (
+    # connections handed out
+    'checkouts',
+    # ... of which were already open in this thread
+    'reuses',
+    # ... of which had to be asked of the adapter
+    'opens',
+    # failed pings, answered with a reconnect
+    'reconnects',
+    # connections dropped after sitting idle
+    'evictions',
+    # adapter errors while connecting
+    'failures',
+    )
+
+
+def isAlive(db):
+    """
+        Ping the connection under a database adapter's DB object;
+        if it has no ping method, assume it's fine.
+    """
+
+    ping = getattr(getattr(db, 'db', None), 'ping', None)
+    if ping is None:
+        return True
+    try:
+        ping()
+    except Exception:
+        return False
+    return True
+
+
+def adapterSpec(da):
+    """
+        (path, DB factory, connection string) of a database adapter,
+        for dedicated(). Read them in the thread that owns da.
+    """
+
+    base = aq_base(da)
+    return ('/'.join(da.getPhysicalPath()), base.factory(), base.connection_string)
+
+
+class ConnectionPool(object):
+    """
+        Per-thread connections from Zope database adapters.
+        Connections idle more than check_interval seconds are
+        pinged before use; those idle more than idle_timeout
+        seconds are dropped by a sweep, made at most every
+        check_interval seconds by whichever thread checks out.
+
+        A sweep closes only the dedicated() connections the pool
+        opened. An adapter's connection belongs to its thread, so
+        the sweep just marks it stale; that thread closes and
+        reconnects it at its next checkout.
+    """
+
+    def __init__(self, check_interval, idle_timeout):
+        self.check_interval = check_interval
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        # (thread, adapter path) -> [db, last used, last checked, close];
+        # close is None for adapter connections
+        self._slots = {}
+        # adapter slot key -> DB object swept while idle
+        self._stale = {}
+        self._stats = dict.fromkeys(stat_names, 0)
+        # seconds spent waiting on adapters to connect
+        self._wait_time = 0.0
+        self._swept = time()
+
+    def _count(self, name, wait=0.0):
+        with self._lock:
+            self._stats[name] += 1
+            self._wait_time += wait
+
+    def _close(self, slot):
+        """ close slot's connection, if the pool opened it """
+
+        if slot[3] is not None:
+            try:
+                slot[3]()
+            except Exception:
+                pass
+
+    def _drop(self, key):
+        """ forget slot key and close its connection if ours """
+
+        with self._lock:
+            slot = self._slots.pop(key, None)
+        if slot is not None:
+            self._close(slot)
+
+    def sweep(self, now=None):
+        """ drop connections idle more than idle_timeout seconds """
+
+        if now is None:
+            now = time()
+        idle = []
+        with self._lock:
+            self._swept = now
+            # take the slots out while holding the lock, so _reuse
+            # can't hand one out once it's been judged idle
+            for key, slot in self._slots.items():
+                if now - slot[1] > self.idle_timeout:
+                    del self._slots[key]
+                    idle.append(slot)
+                    if slot[3] is None:
+                        self._stale[key] = slot[0]
+            self._stats['evictions'] += len(idle)
+        for slot in idle:
+            self._close(slot)
+
+    def _reuse(self, key, now):
+        """
+            the slot's DB object, if it's fit for use; otherwise
+            drop it and return None
+        """
+
+        with self._lock:
+            slot = self._slots.get(key)
+            if slot is None:
+                return None
+            if now - slot[1] > self.idle_timeout:
+                evicted = True
+            else:
+                evicted = False
+                # mark it used, so a sweep leaves it alone
+                slot[1] = now
+                check = now - slot[2] > self.check_interval
+        if evicted:
+            self._count('evictions')
+            self._drop(key)
+            return None
+        db = slot[0]
+        if check:
+            if not isAlive(db):
+                self._count('reconnects')
+                self._drop(key)
+                return None
+            slot[2] = now
+        self._count('reuses')
+        return db
+
+    def _open(self, key, connect, close, now):
+        try:
+            db = connect()
+        except Exception:
+            self._count('failures')
+            raise
+        done = time()
+        self._count('opens', done - now)
+        with self._lock:
+            self._slots[key] = [db, done, done, close]
+        return db
+
+    def _maybeSweep(self, now):
+        if now - self._swept > self.check_interval:
+            self.sweep(now)
+
+    def checkout(self, da):
+        """ return a DB object from the database adapter da """
+
+        base = aq_base(da)
+        key = (get_ident(), '/'.join(da.getPhysicalPath()))
+        now = time()
+        self._count('checkouts')
+        self._maybeSweep(now)
+
+        current = getattr(base, '_v_database_connection', None)
+        with self._lock:
+            slot = self._slots.get(key)
+            stale = self._stale.pop(key, None)
+        # close what a sweep or failed ping left us, unless the
+        # adapter has reconnected behind our back since
+        close = stale is not None and stale is current
+        if slot is not None:
+            if slot[0] is current:
+                db = self._reuse(key, now)
+                if db is not None:
+                    return db
+                close = True
+            else:
+                with self._lock:
+                    self._slots.pop(key, None)
+
+        def connect():
+            # manage_close_connection closes the adapter's
+            # connection but leaves it in place, where da()
+            # would hand it back; connect anew instead
+            if close:
+                try:
+                    da.manage_close_connection()
+                except Exception:
+                    pass
+            if not getattr(base, '_v_connected', None):
+                da.connect(da.connection_string)
+                return da._v_database_connection
+            return da()
+
+        return self._open(key, connect, None, now)
+
+    def dedicated(self, spec):
+        """
+            return a DB object opened from spec, an adapterSpec, for
+            the calling thread alone. Its queries join the thread's
+            Zope transaction; end that after each query, or the
+            connection keeps reading one snapshot.
+        """
+
+        path, factory, connection_string = spec
+        key = (get_ident(), path, connection_string)
+        now = time()
+        self._count('checkouts')
+        self._maybeSweep(now)
+
+        if key in self._slots:
+            db = self._reuse(key, now)
+            if db is not None:
+                return db
+
+        opened = []
+
+        def connect():
+            opened.append(factory(connection_string))
+            return opened[0]
+
+        def close():
+            opened[0].db.close()
+
+        return self._open(key, connect, close, now)
+
+    def stats(self):
+        """ statistics as a dict """
+
+        with self._lock:
+            rez = dict(self._stats)
+            rez['wait_time'] = round(self._wait_time, 3)
+        rez['connections'] = len(self._slots)
+        return rez
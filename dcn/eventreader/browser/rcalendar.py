@@ -6,8 +6,11 @@ rcalendar.py
 Created by Stephen McMahon on 2009-04-15.
 """
 
+from datetime import date, time
+from operator import attrgetter
 from time import localtime
 import caldate
+import formatting
 
 from DateTime import DateTime
 
@@ -23,13 +26,59 @@ from Products.CMFPlone.utils import safe_unicode
 PLMF = MessageFactory('plonelocales')
 
 
-def _toampm(s):
-    if s:
-        t = (DateTime('1-1-2010 ' + s).AMPMMinutes())
-        if t[0] == '0':
-            t = t[1:]
-        return t.replace(' ', '').replace('12:00am', '')
-    return s
+def _ampm(dt):
+    """ 7:30pm from a DateTime; all-day (midnight) events get '' """
+
+    if dt.hour() or dt.minute():
+        return formatting.timeLabel(time(dt.hour(), dt.minute()))
+    return ''
+
+
+def _timeLabel(hour, minute, ampm):
+    # as DateTime's AMPMMinutes().lstrip('0') or TimeMinutes()
+    if ampm:
+        return "%i:%02i %s" % (hour % 12 or 12, minute, hour < 12 and 'am' or 'pm')
+    return "%02i:%02i" % (hour, minute)
+
+
+class Occurrence(object):
+    """
+        One occurrence of a catalog event, read as the tuple
+        (start DateTime, start label, catalog result). The DateTime
+        is made on first use, so only rendered occurrences pay for it.
+    """
+
+    __slots__ = ('key', 'label', 'result', '_start')
+
+    # templates and skin scripts index these, as they did the tuples
+    __allow_access_to_unprotected_subobjects__ = 1
+
+    def __init__(self, ordinal, hour, minute, label, result):
+        self.key = (ordinal, hour, minute)
+        self.label = label
+        self.result = result
+        self._start = None
+
+    def start(self):
+        if self._start is None:
+            day = date.fromordinal(self.key[0])
+            self._start = DateTime(day.year, day.month, day.day, self.key[1], self.key[2])
+        return self._start
+
+    def __len__(self):
+        return 3
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return tuple(self)[i]
+        if i in (0, -3):
+            return self.start()
+        return (None, self.label, self.result)[i]
+
+    def __iter__(self):
+        yield self.start()
+        yield self.label
+        yield self.result
 
 
 class RCalendar(BrowserView):
@@ -44,6 +93,8 @@ class RCalendar(BrowserView):
         self.calendar = getToolByName(self.context, 'portal_calendar')
         self._ts = getToolByName(self.context, 'translation_service')
         self.url_quote_plus = url_quote_plus
+        # subject -> CSS class, for this request
+        self._subject_classes = {}
 
         self.now = localtime()
         self.yearmonth = yearmonth = self.getYearAndMonthToDisplay()
@@ -108,70 +159,63 @@ class RCalendar(BrowserView):
         ctool = getToolByName(self, 'portal_catalog')
         query = ctool(**query_args)
 
-        # compile a list of the days that have events
-        eventDays = {}
-        for daynumber in range(1, 32):  # 1 to 31
-            eventDays[daynumber] = {'eventslist': [],
-                                    'event': 0,
-                                    'day': daynumber}
-        includedevents = []
+        # events by day number; index 0 is unused
+        days = [[] for i in range(last_day + 1)]
+        month_start = caldate.toOrdinal(first_date)
+        month_end = month_start + last_day - 1
+        seen = set()
         for result in query:
-            if result.getRID() in includedevents:
-                break
-            else:
-                includedevents.append(result.getRID())
-
-            # we need to deal with events that end after this month
-            if (result.end.year(), result.end.month()) != (year, month):
-                eventEndDay = last_day
-                eventEndDate = last_date
-            else:
-                eventEndDay = result.end.day()
-                eventEndDate = result.end
-
-            # and events that started last month
-            if (result.start.year(), result.start.month()) != (year, month):
-                eventStartDay = 1
-                eventStartDate = first_date
-            else:
-                eventStartDay = result.start.day()
-                eventStartDate = result.start
-
-            # and recurrence
-            recurs = result.recurs
-            start = result.start.earliestTime()
-            if recurs == 'weekly':
-                dates = caldate.weekly(eventStartDate, eventEndDate, start)
-                allEventDays = [e.day() for e in dates]
-            elif recurs == 'biweekly':
-                dates = caldate.biweekly(eventStartDate, eventEndDate, start)
-                allEventDays = [e.day() for e in dates]
-            elif recurs == 'monthly':
-                dates = caldate.monthly(eventStartDate, eventEndDate, start)
-                allEventDays = [e.day() for e in dates]
-            else:  # daily
-                allEventDays = range(eventStartDay, eventEndDay + 1)
-
-            # construct subject class selectors
-            exclasses = ' '.join(["subject-%s" % url_quote_plus(s).replace('+', '-') for s in result.Subject])
+            rid = result.getRID()
+            if rid in seen:
+                continue
+            seen.add(rid)
+
+            # recurrence, clipped to the month
+            ordinals = caldate.rangeOrdinals(
+                month_start,
+                min(month_end, caldate.toOrdinal(result.end)),
+                caldate.toOrdinal(result.start),
+                getattr(result, 'recurs', 'daily'),
+                )
 
             # construct dictionary to return for event
-            st = result.start.AMPMMinutes().lstrip('0')
             event = {'end': None,
-                     'start': st,
+                     'start': _ampm(result.start),
                      'title': result.Title or result.getId,
                      'desc': result.Description,
                      'url': result.getURL(),
-                     'exclasses': exclasses,
+                     'exclasses': self.subjectClasses(result.Subject),
                     }
 
             # put event in list
-            for eventday in allEventDays:
-                eventDays[eventday]['eventslist'].append(event)
-                eventDays[eventday]['event'] = 1
+            for o in ordinals:
+                days[o - month_start + 1].append(event)
+
+        # compile a list of the days that have events
+        eventDays = {}
+        for daynumber in range(1, 32):  # 1 to 31
+            if daynumber <= last_day and days[daynumber]:
+                eventslist = days[daynumber]
+            else:
+                eventslist = []
+            eventDays[daynumber] = {'eventslist': eventslist,
+                                    'event': eventslist and 1 or 0,
+                                    'day': daynumber}
 
         return eventDays
 
+    def subjectClasses(self, subjects):
+        """ subject-* CSS class selectors for a list of subjects """
+
+        classes = self._subject_classes
+        rez = []
+        for subject in subjects:
+            cls = classes.get(subject)
+            if cls is None:
+                cls = classes[subject] = "subject-%s" % url_quote_plus(subject).replace('+', '-')
+            rez.append(cls)
+        return ' '.join(rez)
+
     def getEventsForCalendar(self):
         context = aq_inner(self.context)
         year = self.year
@@ -188,9 +232,6 @@ class RCalendar(BrowserView):
                 if day['event']:
                     cur_date = DateTime(year, month, daynumber)
                     localized_date = [self._ts.ulocalized_time(cur_date, context=context, request=self.request)]
-                    for e in day['eventslist']:
-                        e['start'] = _toampm(e['start'])
-                        e['end'] = _toampm(e['end'])
                     day['eventstring'] = '\n'.join(
                             localized_date + [' %s' % self.getEventString(e) for e in day['eventslist']]
                             )
@@ -293,7 +334,9 @@ class RCalendar(BrowserView):
         return query_string
 
     def getevents(self, first, last, **kwa):
-        """ given start and end dates, return a list of days that have events
+        """ given start and end dates, return a list of the occurrences
+            of events between them, in start order; each reads as a
+            (start DateTime, start time string, catalog result) tuple
         """
 
         ctool = self.calendar
@@ -315,38 +358,31 @@ class RCalendar(BrowserView):
 
         # compile a list of the days that have events
         events = []
+        lo = caldate.toOrdinal(first_date)
+        hi = caldate.toOrdinal(last_date)
+        labels = {}
 
         for result in query:
 
             # get the dates, taking recurrence into account
-            recurs = getattr(result, 'recurs', 'daily')
             start = result.start
-            ldate = min(last_date, result.end.latestTime())
-            if recurs == 'weekly':
-                dates = caldate.weekly(first_date, ldate, start)
-            elif recurs == 'biweekly':
-                dates = caldate.biweekly(first_date, ldate, start)
-            elif recurs == 'monthly':
-                dates = caldate.monthly(first_date, ldate, start)
-            else:  # daily
-                dates = caldate.daily(first_date, ldate, start)
-
-            if dates:
-                if ampm:
-                    st = result.start.AMPMMinutes().lstrip('0')
-                else:
-                    st = result.start.TimeMinutes()
-
-                time = list(result.start.parts()[3:5])
-                # put event in list
-                for day in dates:
-                    startdt = DateTime(*(list(day.parts()[0:3]) + time))
-                    events.append((startdt, st, result))
-
-        # sort without considering result part
-        events.sort(
-            lambda x, y: cmp(x[:2], y[:2])
-            )
+            ordinals = caldate.rangeOrdinals(
+                lo,
+                min(hi, caldate.toOrdinal(result.end)),
+                caldate.toOrdinal(start),
+                getattr(result, 'recurs', 'daily'),
+                )
+
+            hour, minute = start.hour(), start.minute()
+            st = labels.get((hour, minute))
+            if st is None:
+                st = labels[hour, minute] = _timeLabel(hour, minute, ampm)
+            # put event in list
+            for o in ordinals:
+                events.append(Occurrence(o, hour, minute, st, result))
+
+        # the sort is stable, so same-time events stay in catalog order
+        events.sort(key=attrgetter('key'))
         return events
 
     def getNextDaysEvents(self, days, **kwa):
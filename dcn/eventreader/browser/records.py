@@ -0,0 +1,153 @@
+"""
+
+Compact event rows
+
+An EventRecord wraps a raw result tuple and converts columns (decoding
+strings, making dates of day ordinals and times of seconds) the first
+time each one is read. The begins and ends display labels are derived
+from the native start and end times through formatting. Records
+answer the read-only dict protocol, so templates and callers can keep
+using event/title, event['begins'] and event.get('acronym').
+
+    >>> schema = getSchema(['eid', 'title', 'start', 'startTime'])
+    >>> rec = EventRecord(schema, (7, 'Caf\\xe9', 734655, 70200))
+    >>> rec['title'], rec['start'], rec.get('begins'), rec.get('nope', 0)
+    (u'Caf\\xe9', datetime.date(2012, 6, 1), u'7:30pm', 0)
+    >>> rec['startTime'], rec['start'] is rec['start'], 'eid' in rec
+    (datetime.time(19, 30), True, True)
+    >>> sorted(rec.keys())
+    ['begins', 'eid', 'start', 'startTime', 'title']
+    >>> rec = EventRecord(schema, (8, 'All day', 734655, None))
+    >>> rec['startTime'], rec['begins']
+    (None, None)
+
+"""
+
+import formatting
+
+
+def decode(val):
+    # strings are win1252 in the database
+    if type(val) == str:
+        return val.decode('Windows-1252', 'replace')
+    return val
+
+
+# converters for the columns of the event range queries
+event_converters = {
+    'start': formatting.ordinalToDate,
+    'end': formatting.ordinalToDate,
+    'date': formatting.ordinalToDate,
+    'startTime': formatting.secondsToTime,
+    'endTime': formatting.secondsToTime,
+    }
+
+# name: (source column, function) for values computed from others
+event_derived = {
+    'begins': ('startTime', formatting.timeLabel),
+    'ends': ('endTime', formatting.timeLabel),
+    }
+
+
+class RecordSchema(object):
+    """
+        Column names and per-column converters for the records
+        of one query; columns without a converter are decoded.
+        Derived values whose source column is present follow
+        the columns.
+    """
+
+    def __init__(self, names, converters, derived):
+        self.width = len(names)
+        self.derived = tuple([
+            (name, derived[name]) for name in sorted(derived)
+            if derived[name][0] in names and name not in names
+            ])
+        self.names = tuple(names) + tuple([d[0] for d in self.derived])
+        self.padding = (None, ) * len(self.derived)
+        self.index = dict([(name, i) for i, name in enumerate(self.names)])
+        self.converters = tuple([
+            converters.get(name, decode) for name in names
+            ])
+
+
+_schemas = {}
+
+
+def getSchema(names, converters=event_converters, derived=event_derived):
+    """ shared RecordSchema for a column list """
+
+    key = (tuple(names), id(converters), id(derived))
+    schema = _schemas.get(key)
+    if schema is None:
+        schema = _schemas[key] = RecordSchema(names, converters, derived)
+    return schema
+
+
+def makeRecords(result, converters=event_converters, derived=event_derived):
+    """ EventRecords from a database adapter's (items, rows) result """
+
+    items, rows = result
+    schema = getSchema([item['name'] for item in items], converters, derived)
+    return [EventRecord(schema, row) for row in rows]
+
+
+class EventRecord(object):
+    """
+        One event row. Read-only: results are shared by caches.
+        Threads may race to convert a column; converters take
+        their own output unchanged, so that's harmless.
+    """
+
+    __slots__ = ('_schema', '_values', '_converted')
+
+    __allow_access_to_unprotected_subobjects__ = 1
+
+    def __init__(self, schema, row):
+        self._schema = schema
+        self._values = list(row)
+        if schema.padding:
+            self._values.extend(schema.padding)
+        # bit i set once column i has been converted
+        self._converted = 0
+
+    def __getitem__(self, key):
+        i = self._schema.index[key]
+        bit = 1 << i
+        if not self._converted & bit:
+            schema = self._schema
+            if i < schema.width:
+                self._values[i] = schema.converters[i](self._values[i])
+            else:
+                source, func = schema.derived[i - schema.width][1]
+                self._values[i] = func(self[source])
+            self._converted |= bit
+        return self._values[i]
+
+    def get(self, key, default=None):
+        if key in self._schema.index:
+            return self[key]
+        return default
+
+    def __contains__(self, key):
+        return key in self._schema.index
+
+    has_key = __contains__
+
+    def keys(self):
+        return list(self._schema.names)
+
+    def __iter__(self):
+        return iter(self._schema.names)
+
+    def __len__(self):
+        return len(self._schema.names)
+
+    def values(self):
+        return [self[key] for key in self._schema.names]
+
+    def items(self):
+        return [(key, self[key]) for key in self._schema.names]
+
+    def __repr__(self):
+        return '<EventRecord %r>' % (self.get('eid'), )
@@ -0,0 +1,156 @@
+"""
+
+Read replicas
+
+dbCal and dbCalWriter are acquired separately, but normally both are
+the primary database. With read-replicas set to the ids of more
+database adapters, acquired the same way, EventDatabaseProvider sends
+its reads to one of them. Replicas that answer quickly are preferred;
+one that fails is left alone for replica-retry seconds, and the read
+goes to dbCal instead.
+
+Replicas lag, so writes send reads back to the primary for
+primary-pin-seconds: in this process, so nothing stale is cached
+again after a write clears the caches, and, through a cookie, for the
+editor who wrote, so @@caledit shows the change at once.
+
+    >>> replicas = ReplicaSet(['r1', 'r2'], retry=30)
+    >>> replicas.failed('r1', now=100)
+    >>> replicas.choose(now=110), replicas.choose(now=131) in ('r1', 'r2')
+    ('r2', True)
+    >>> replicas.failed('r1', now=140)
+    >>> replicas.failed('r2', now=140)
+    >>> print replicas.choose(now=150)
+    None
+
+"""
+
+import logging
+import random
+import threading
+from time import time
+
+from config import getSetting
+
+
+logger = logging.getLogger('dcn.eventreader.replicas')
+
+# weight of the latest read in a replica's average
+latency_weight = 0.2
+
+pin_cookie = 'dcn.eventreader.primary'
+
+
+class ReplicaSet(object):
+    """
+        Health of replica database adapters, by id. choose takes
+        the faster of two healthy replicas picked at random, which
+        spreads reads while favoring those answering quickly.
+    """
+
+    def __init__(self, ids, retry):
+        self.ids = tuple(ids)
+        self.retry = retry
+        self._lock = threading.Lock()
+        # id -> [average seconds per read, reads, failures, down until]
+        self._health = dict([(name, [0.0, 0, 0, 0.0]) for name in self.ids])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def choose(self, now=None):
+        """ id of a replica to read from; None if all are down """
+
+        if now is None:
+            now = time()
+        with self._lock:
+            up = [name for name in self.ids if self._health[name][3] <= now]
+            if len(up) < 2:
+                return up and up[0] or None
+            return min(random.sample(up, 2), key=lambda name: self._health[name][0])
+
+    def succeeded(self, name, seconds):
+        with self._lock:
+            health = self._health[name]
+            if health[1]:
+                health[0] += (seconds - health[0]) * latency_weight
+            else:
+                health[0] = seconds
+            health[1] += 1
+            health[2] = 0
+
+    def failed(self, name, now=None):
+        """ take name out of use for retry seconds """
+
+        if now is None:
+            now = time()
+        with self._lock:
+            health = self._health[name]
+            health[2] += 1
+            health[3] = now + self.retry
+
+    def stats(self):
+        """ {id: {ms, reads, failures, down}} """
+
+        now = time()
+        rez = {}
+        with self._lock:
+            for name in self.ids:
+                seconds, reads, failures, until = self._health[name]
+                rez[name] = {
+                    'ms': round(seconds * 1000, 1),
+                    'reads': reads,
+                    'failures': failures,
+                    'down': until > now,
+                    }
+        return rez
+
+
+replica_set = ReplicaSet(
+    getSetting('read-replicas').split(),
+    getSetting('replica-retry'),
+    )
+
+pin_seconds = getSetting('primary-pin-seconds')
+
+# when this process last wrote
+last_write = 0.0
+
+
+def pinPrimary(request):
+    """
+        After a write: read from the primary for pin_seconds, in this
+        process and in the request's browser session
+    """
+
+    global last_write
+    last_write = time()
+    if not replica_set or not pin_seconds or request is None:
+        return
+    response = getattr(request, 'response', None)
+    if response is not None:
+        response.setCookie(
+            pin_cookie, '%i' % (last_write + pin_seconds),
+            path='/', max_age=pin_seconds,
+            )
+
+
+def sessionPinned(request):
+    """ has request's browser written within pin_seconds? """
+
+    cookies = getattr(request, 'cookies', None)
+    if not cookies:
+        return False
+    try:
+        until = int(cookies.get(pin_cookie, 0))
+    except ValueError:
+        return False
+    now = time()
+    # a forged cookie can't pin for longer than we would
+    return now < until <= now + pin_seconds
+
+
+def pinned(request):
+    """ should reads for request go to the primary? """
+
+    return time() - last_write < pin_seconds or sessionPinned(request)
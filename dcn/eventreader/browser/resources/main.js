@@ -1,24 +1,94 @@
 jQuery(function ($) {
     // event view overlays
-    $('table.ploneCalendar li.caleventtitle a, dd.infobuttons a').prepOverlay({
-        subtype:'ajax',
-        formselector: '#form',
-        closeselector: '#form-buttons-cancel',
-//        filter: common_content_filter,
-        filter: "#content",
-        noform: function(el) {return $.plonepopups.noformerrorshow(el, 'redirect');},
-        redirect: '@@caledit',
-        afterpost: function (el, data_parent) {
-            var val = el.find('#form-widgets-recurs').val();
-            // console.log(val);
-            if (val === "Irregularly") {
-                el.find("#formfield-form-widgets-end").hide();
-                el.find("#formfield-form-widgets-start").hide();
-            } else {
-                el.find("#formfield-form-widgets-dates").hide();
+    function prep_overlays(links) {
+        links.prepOverlay({
+            subtype:'ajax',
+            formselector: '#form',
+            closeselector: '#form-buttons-cancel',
+//            filter: common_content_filter,
+            filter: "#content",
+            noform: function(el) {return $.plonepopups.noformerrorshow(el, 'redirect');},
+            redirect: '@@caledit',
+            afterpost: function (el, data_parent) {
+                var val = el.find('#form-widgets-recurs').val();
+                // console.log(val);
+                if (val === "Irregularly") {
+                    el.find("#formfield-form-widgets-end").hide();
+                    el.find("#formfield-form-widgets-start").hide();
+                } else {
+                    el.find("#formfield-form-widgets-dates").hide();
+                }
             }
+        });
+    }
+    prep_overlays($('table.ploneCalendar li.caleventtitle a, dd.infobuttons a'));
+
+    // client-side calendar navigation: swap in the @@calendar-grid
+    // fragment rather than loading the whole page
+    var grid_cache = {};
+
+    function grid_url(href) {
+        var base = $('#calgrid').attr('data-grid-url'),
+            i = href.indexOf('?');
+        return i < 0 ? base : base + href.substring(i);
+    }
+
+    function fetch_grid(href) {
+        var url = grid_url(href);
+        if (!grid_cache[url]) {
+            grid_cache[url] = $.ajax({url: url, dataType: 'html'});
+            grid_cache[url].fail(function () {
+                delete grid_cache[url];
+            });
         }
-    });
+        return grid_cache[url];
+    }
+
+    function prefetch_adjacent() {
+        $('#calnav a.arrow').each(function () {
+            fetch_grid(this.href);
+        });
+    }
+
+    function show_grid(href, push) {
+        fetch_grid(href).done(function (html) {
+            var grid = $('#calgrid'),
+                fresh = $('<div />').html(html).find('#calgrid');
+            if (!fresh.length) {
+                window.location = href;
+                return;
+            }
+            grid.parent()
+                .removeClass('calmode-' + grid.attr('data-mode'))
+                .addClass('calmode-' + fresh.attr('data-mode'));
+            grid.replaceWith(fresh);
+            prep_overlays(fresh.find('table.ploneCalendar li.caleventtitle a'));
+            if (push) {
+                window.history.pushState({calgrid: href}, '', href);
+            }
+            prefetch_adjacent();
+        }).fail(function () {
+            window.location = href;
+        });
+    }
+
+    if ($('#calgrid[data-grid-url]').length && window.history && window.history.pushState) {
+        $(document).on('click', '#calmode a, #calnav a, #calcats a', function (event) {
+            if (event.which > 1 || event.metaKey || event.ctrlKey || event.shiftKey) {
+                return;
+            }
+            event.preventDefault();
+            show_grid(this.href, true);
+        });
+        window.history.replaceState({calgrid: window.location.href}, '');
+        $(window).on('popstate', function (event) {
+            var state = event.originalEvent.state;
+            if (state && state.calgrid) {
+                show_grid(state.calgrid, false);
+            }
+        });
+        prefetch_adjacent();
+    }
 
     function show_hide_dates() {
         var val = $('#form-widgets-recurs').val();
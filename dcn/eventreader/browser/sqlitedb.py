@@ -0,0 +1,428 @@
+"""
+
+Event database on an embedded SQLite file
+
+A stand-in for the dbCal MySQL database, for profiling and load tests
+where the production database isn't at hand. SQLiteDatabase answers
+the part of the Zope database adapter interface the providers use --
+query() returning (items, rows), with \\0-separated statements run in
+turn, and sql_quote__ -- and translates the MySQL dialect of
+dbaccess: INSERT ... SET, INSERT IGNORE, IF(), INTERVAL arithmetic,
+double-quoted strings, last_insert_id(), ROW_COUNT(), and the date
+functions, which are registered as SQLite functions.
+
+    >>> print translate('INSERT INTO Orgs SET name="A \\\\"b\\\\"", url=NOW()')
+    INSERT INTO Orgs (name, url) VALUES ('A "b"', NOW())
+    >>> print translate("SELECT IF(a >= NOW(), a + INTERVAL 1 SECOND, NOW())")
+    SELECT mysql_if(a >= NOW(), DATETIME(a, '+1 seconds'), NOW())
+    >>> to_days('2012-06-01') - 365, time_to_sec('19:30')
+    (734655, 70200)
+    >>> date_format('2012-06-01 19:05:09', '%Y-%m-%d %H:%i:%s')
+    '2012-06-01 19:05:09'
+
+Select it with sqlite-overrides.zcml; the file named by the
+sqlite-file setting is created, with the calendar tables, on first
+use. Statements commit as they run, as they do on MyISAM tables.
+
+"""
+
+import os
+import re
+import sqlite3
+import threading
+from datetime import date, datetime
+from time import mktime
+
+import Acquisition
+from App.config import getConfiguration
+from plone.app.layout.navigation.interfaces import INavigationRoot
+
+from config import getSetting
+from dbaccess import EventDatabaseProvider, EventDatabaseWriteProvider
+
+
+schema_ddl = (
+    """
+    CREATE TABLE IF NOT EXISTS Orgs (
+        oid INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT DEFAULT '',
+        acronym TEXT DEFAULT '',
+        description TEXT DEFAULT '',
+        url TEXT DEFAULT '',
+        alt_cal_url TEXT DEFAULT '',
+        contact TEXT DEFAULT '',
+        email TEXT DEFAULT '',
+        phone TEXT DEFAULT '',
+        ccal_link INTEGER DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS Events (
+        eid INTEGER PRIMARY KEY AUTOINCREMENT,
+        oid INTEGER NOT NULL,
+        startTime TEXT,
+        endTime TEXT,
+        title TEXT DEFAULT '',
+        description TEXT DEFAULT '',
+        public TEXT DEFAULT '',
+        free TEXT DEFAULT '',
+        location TEXT DEFAULT '',
+        community TEXT DEFAULT '',
+        eventUrl TEXT DEFAULT '',
+        eventContact TEXT DEFAULT '',
+        eventEmail TEXT DEFAULT '',
+        eventPhone TEXT DEFAULT '',
+        udf1 TEXT DEFAULT '',
+        udf2 TEXT DEFAULT '',
+        lastUpdator TEXT DEFAULT '',
+        lastUpdated TEXT
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS Events_oid ON Events (oid)",
+    """
+    CREATE TABLE IF NOT EXISTS EvDates (
+        eid INTEGER NOT NULL,
+        sdate TEXT NOT NULL,
+        edate TEXT NOT NULL,
+        recurs TEXT DEFAULT 'daily'
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS EvDates_eid ON EvDates (eid)",
+    "CREATE INDEX IF NOT EXISTS EvDates_dates ON EvDates (sdate, edate)",
+    """
+    CREATE TABLE IF NOT EXISTS EvCats (
+        eid INTEGER NOT NULL,
+        gcid INTEGER NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS EvCats_eid ON EvCats (eid)",
+    "CREATE INDEX IF NOT EXISTS EvCats_gcid ON EvCats (gcid)",
+    """
+    CREATE TABLE IF NOT EXISTS GlobalCategories (
+        gcid INTEGER PRIMARY KEY,
+        title TEXT DEFAULT '',
+        oid INTEGER NOT NULL,
+        major INTEGER DEFAULT 0
+    )
+    """,
+    # MySQL numbers an AUTO_INCREMENT column given 0; updateOrgCats relies on it
+    """
+    CREATE TRIGGER IF NOT EXISTS GlobalCategories_gcid
+    AFTER INSERT ON GlobalCategories WHEN NEW.gcid = 0
+    BEGIN
+        UPDATE GlobalCategories
+        SET gcid = (SELECT MAX(gcid) + 1 FROM GlobalCategories)
+        WHERE gcid = 0;
+    END
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS EvOccurrences (
+        eid INTEGER NOT NULL,
+        date TEXT NOT NULL,
+        PRIMARY KEY (date, eid)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS EvOccurrences_eid ON EvOccurrences (eid)",
+    )
+
+schema_tables = ('Orgs', 'Events', 'EvDates', 'EvCats',
+    'GlobalCategories', 'EvOccurrences')
+
+
+##########################
+# MySQL functions
+
+def to_days(val):
+    if not val:
+        return None
+    return date(*[int(s) for s in str(val)[:10].split('-')]).toordinal() + 365
+
+
+def time_to_sec(val):
+    if val is None:
+        return None
+    parts = [int(s) for s in str(val).split(':') if s.strip()] + [0, 0, 0]
+    return parts[0] * 3600 + parts[1] * 60 + parts[2]
+
+
+def parseDateTime(val):
+    val = str(val)
+    if len(val) <= 8 and ':' in val:
+        val = '1900-01-01 %s' % val
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(val, fmt)
+        except ValueError:
+            pass
+    return None
+
+
+def unix_timestamp(val=None):
+    if val is None:
+        return None
+    dt = parseDateTime(val)
+    if dt is None:
+        return 0
+    return int(mktime(dt.timetuple()))
+
+
+# MySQL DATE_FORMAT specifiers -> strftime directives or functions
+format_codes = {
+    'Y': '%Y', 'y': '%y', 'm': '%m', 'd': '%d', 'H': '%H',
+    'h': '%I', 'I': '%I', 'i': '%M', 's': '%S', 'S': '%S',
+    'p': '%p', 'M': '%B', 'b': '%b', 'W': '%A', 'a': '%a',
+    'c': lambda dt: str(dt.month),
+    'e': lambda dt: str(dt.day),
+    'k': lambda dt: str(dt.hour),
+    'l': lambda dt: str(dt.hour % 12 or 12),
+    '%': '%%',
+    }
+
+
+def date_format(val, fmt):
+    if val is None or fmt is None:
+        return None
+    dt = parseDateTime(val)
+    if dt is None:
+        return None
+
+    def replace(match):
+        code = format_codes.get(match.group(1))
+        if code is None:
+            return match.group(1)
+        if callable(code):
+            return code(dt)
+        return dt.strftime(code)
+    return re.sub('%(.)', replace, fmt)
+
+
+def now():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def mysql_if(test, a, b):
+    if test:
+        return a
+    return b
+
+
+functions = (
+    ('TO_DAYS', 1, to_days),
+    ('TIME_TO_SEC', 1, time_to_sec),
+    ('UNIX_TIMESTAMP', 1, unix_timestamp),
+    ('DATE_FORMAT', 2, date_format),
+    ('TIME_FORMAT', 2, date_format),
+    ('NOW', 0, now),
+    ('mysql_if', 3, mysql_if),
+    )
+
+
+##########################
+# dialect translation
+
+literal_pattern = re.compile(r"""'(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*\"""")
+escape_pattern = re.compile(r"""\\(.)|''|\"\"""")
+escapes = {'n': '\n', 't': '\t', 'r': '\r', '0': '\0', 'Z': '\x1a'}
+
+rewrites = (
+    (re.compile(r'\bINSERT\s+IGNORE\b', re.I), 'INSERT OR IGNORE'),
+    (re.compile(r'\blast_insert_id\(\)', re.I), 'last_insert_rowid()'),
+    (re.compile(r'\bROW_COUNT\(\)', re.I), 'changes()'),
+    (re.compile(r'\bIF\s*\(', re.I), 'mysql_if('),
+    (re.compile(r'([\w.]+)\s*\+\s*INTERVAL\s+(\d+)\s+SECOND\b', re.I),
+        r"DATETIME(\1, '+\2 seconds')"),
+    )
+
+insert_set_pattern = re.compile(
+    r'^\s*INSERT\s+INTO\s+(\w+)\s+SET\s+(.*?)\s*$', re.I | re.S)
+
+
+def unquote(literal):
+    """ the value of a MySQL string literal """
+
+    mark = literal[0]
+
+    def unescape(match):
+        if match.group(1) is not None:
+            return escapes.get(match.group(1), match.group(1))
+        if match.group(0) == mark * 2:
+            return mark
+        return match.group(0)
+    return escape_pattern.sub(unescape, literal[1:-1])
+
+
+def quote(val):
+    """ SQLite string literal for val """
+
+    return "'%s'" % val.replace("'", "''")
+
+
+def splitTop(text):
+    """ split text on commas outside parentheses """
+
+    parts = []
+    depth = start = 0
+    for i, c in enumerate(text):
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            parts.append(text[start:i])
+            start = i + 1
+    parts.append(text[start:])
+    return [part.strip() for part in parts]
+
+
+def translate(statement):
+    """ a MySQL statement from dbaccess in SQLite's dialect """
+
+    literals = []
+
+    def mask(match):
+        literals.append(quote(unquote(match.group(0))))
+        return '\x01%i\x01' % (len(literals) - 1)
+    masked = literal_pattern.sub(mask, statement)
+
+    for pattern, replacement in rewrites:
+        masked = pattern.sub(replacement, masked)
+
+    match = insert_set_pattern.match(masked)
+    if match:
+        columns = []
+        values = []
+        for assignment in splitTop(match.group(2)):
+            column, value = assignment.split('=', 1)
+            columns.append(column.strip())
+            values.append(value.strip())
+        masked = 'INSERT INTO %s (%s) VALUES (%s)' % (
+            match.group(1), ', '.join(columns), ', '.join(values))
+
+    return re.sub(
+        '\x01(\\d+)\x01', lambda m: literals[int(m.group(1))], masked)
+
+
+def fromDatabase(val):
+    # reads come back as win1252 bytes, as they do from MySQL
+    return val.decode('utf-8').encode('Windows-1252', 'replace')
+
+
+class SQLiteDatabase(object):
+    """
+        The database adapter interface over one SQLite file,
+        with a connection per thread.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._created = False
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None)
+            conn.text_factory = fromDatabase
+            for name, nargs, func in functions:
+                conn.create_function(name, nargs, func)
+            with self._lock:
+                if not self._created:
+                    for ddl in schema_ddl:
+                        conn.execute(ddl)
+                    self._created = True
+            self._local.conn = conn
+        return conn
+
+    def __call__(self):
+        # as for a database adapter, calling returns the DB object
+        return self
+
+    def sql_quote__(self, val):
+        # MySQL-style, so translate reads it as dbaccess's own strings do
+        return "'%s'" % str(val).replace('\\', '\\\\').replace("'", "\\'")
+
+    def query(self, query_string, max_rows=None):
+        """ (items, rows) of the last of the \\0-separated statements """
+
+        conn = self._connection()
+        items, rows = (), ()
+        for statement in query_string.split('\0'):
+            if not statement.strip():
+                continue
+            if isinstance(statement, str):
+                statement = statement.decode('Windows-1252')
+            # the calendar tables already exist here
+            words = statement.split()
+            if (words[:5] == ['CREATE', 'TABLE', 'IF', 'NOT', 'EXISTS']
+                    and words[5] in schema_tables):
+                continue
+            cursor = conn.execute(translate(statement))
+            if cursor.description:
+                items = [
+                    {'name': d[0], 'type': 's', 'width': 0, 'null': 1}
+                    for d in cursor.description
+                    ]
+                if max_rows:
+                    rows = cursor.fetchmany(max_rows)
+                else:
+                    rows = cursor.fetchall()
+            else:
+                items, rows = (), ()
+        return items, rows
+
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+def getDatabase():
+    """ the process's SQLiteDatabase for the sqlite-file setting """
+
+    path = getSetting('sqlite-file') or os.path.join(
+        getConfiguration().clienthome, 'eventreader.sqlite')
+    with _databases_lock:
+        db = _databases.get(path)
+        if db is None:
+            db = _databases[path] = SQLiteDatabase(path)
+    return db
+
+
+class SQLiteEventDatabaseProvider(EventDatabaseProvider):
+    """
+        EventDatabaseProvider reading the SQLite stand-in
+    """
+
+    def __init__(self, context):
+        self.context = context
+        self.dbCal = self.reader = getDatabase()
+        self.request = Acquisition.aq_get(context, 'REQUEST', None)
+        if INavigationRoot.providedBy(context):
+            self.db_org_id = getattr(context, 'dbOrgId', 0)
+        else:
+            self.db_org_id = 0
+
+    def _workerSpec(self):
+        return None
+
+    def _workerReader(self, spec):
+        # SQLiteDatabase connects per thread already
+        return self.reader
+
+    def _readReplica(self):
+        return None
+
+
+class SQLiteEventDatabaseWriteProvider(EventDatabaseWriteProvider):
+    """
+        EventDatabaseWriteProvider writing the SQLite stand-in
+    """
+
+    def __init__(self, context):
+        self.context = context
+        self.dbCal = self.reader = getDatabase()
+        self.request = Acquisition.aq_get(context, 'REQUEST', None)
+        if INavigationRoot.providedBy(context):
+            self.db_org_id = getattr(context, 'dbOrgId', 0)
+        else:
+            self.db_org_id = 0
@@ -0,0 +1,174 @@
+"""
+
+Per-request timing breakdown
+
+With the server-timing setting on, each request gets a RequestTimings
+in its annotations, and the code it runs charges time to phases:
+sql (in the database providers), expand (recurrence expansion), urls
+(myUrl and getCats) and render (the page template). Phases nest; time
+goes to the innermost, so the numbers add up. EventQueryView reports
+them in a Server-Timing header, and requests slower than
+slow-request-ms are logged.
+
+With the setting off, getTimings returns None and the timed methods
+cost one attribute test.
+
+    >>> t = RequestTimings()
+    >>> with t.timer('render'):
+    ...     with t.timer('sql'):
+    ...         t.addRows('sql', 12)
+    >>> sorted(t.phases), t.phases['sql'][1:]
+    (['render', 'sql'], [1, 12])
+    >>> 'sql;dur=' in t.header(), 'desc="1 call, 12 rows"' in t.header()
+    (True, True)
+
+"""
+
+import json
+import logging
+from time import time
+
+from zope.annotation.interfaces import IAnnotations
+
+from config import getSetting
+
+
+logger = logging.getLogger('dcn.eventreader.timing')
+
+enabled = getSetting('server-timing')
+slow_request = getSetting('slow-request-ms') / 1000.0
+
+timings_key = 'dcn.eventreader.timings'
+
+
+class RequestTimings(object):
+    """
+        Seconds, calls and rows by phase for one request
+    """
+
+    def __init__(self):
+        self.started = time()
+        # name -> [seconds, calls, rows]
+        self.phases = {}
+        self.order = []
+        # [name, resumed at] for the phases we're inside
+        self._stack = []
+
+    def _phase(self, name):
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = [0.0, 0, 0]
+            self.order.append(name)
+        return phase
+
+    def timer(self, name):
+        return PhaseTimer(self, name)
+
+    def _enter(self, name):
+        now = time()
+        if self._stack:
+            outer = self._stack[-1]
+            self.phases[outer[0]][0] += now - outer[1]
+        self._phase(name)[1] += 1
+        self._stack.append([name, now])
+
+    def _exit(self):
+        now = time()
+        name, resumed = self._stack.pop()
+        self.phases[name][0] += now - resumed
+        if self._stack:
+            self._stack[-1][1] = now
+
+    def addRows(self, name, rows):
+        self._phase(name)[2] += rows
+
+    def total(self):
+        return time() - self.started
+
+    def header(self):
+        """ Server-Timing header value, durations in milliseconds """
+
+        parts = []
+        for name in self.order:
+            seconds, calls, rows = self.phases[name]
+            desc = "%i call%s" % (calls, calls != 1 and 's' or '')
+            if rows:
+                desc = "%s, %i rows" % (desc, rows)
+            parts.append('%s;dur=%.1f;desc="%s"' % (name, seconds * 1000, desc))
+        parts.append('total;dur=%.1f' % (self.total() * 1000))
+        return ', '.join(parts)
+
+    def record(self):
+        """ the timings as a dict, for the slow-request log """
+
+        rez = {'total_ms': round(self.total() * 1000, 1)}
+        for name in self.order:
+            seconds, calls, rows = self.phases[name]
+            rez[name] = {
+                'ms': round(seconds * 1000, 1),
+                'calls': calls,
+                'rows': rows,
+                }
+        return rez
+
+
+class PhaseTimer(object):
+    """ context manager charging the time inside it to a phase """
+
+    __slots__ = ('timings', 'name')
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.timings._enter(self.name)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timings._exit()
+        return False
+
+
+def getTimings(request):
+    """ the request's RequestTimings; None if timing is off """
+
+    if not enabled or request is None:
+        return None
+    annotations = IAnnotations(request, None)
+    if annotations is None:
+        return None
+    timings = annotations.get(timings_key)
+    if timings is None:
+        timings = annotations[timings_key] = RequestTimings()
+    return timings
+
+
+def timed(name):
+    """
+        Decorator for view methods: charge the call to phase name
+        when the view's timings attribute isn't None.
+    """
+
+    def decorator(method):
+        def wrapper(self, *args, **kwargs):
+            timings = self.timings
+            if timings is None:
+                return method(self, *args, **kwargs)
+            with timings.timer(name):
+                return method(self, *args, **kwargs)
+        wrapper.__name__ = method.__name__
+        wrapper.__doc__ = method.__doc__
+        return wrapper
+    return decorator
+
+
+def finish(request, timings):
+    """ send the Server-Timing header; log the request if it was slow """
+
+    request.response.setHeader('Server-Timing', timings.header())
+    if slow_request and timings.total() >= slow_request:
+        rez = timings.record()
+        rez['url'] = request.get('ACTUAL_URL', '')
+        rez['query'] = request.get('QUERY_STRING', '')
+        logger.warning("slow request %s", json.dumps(rez, sort_keys=True))
@@ -24,6 +24,11 @@ class IUpcomingPortlet(IPortletDataProvider):
                        required=True,
                        default=5)
 
+    plone_events = schema.Bool(title=_(u'Include Plone events'),
+                               description=_(u'Merge in Event content from this site.'),
+                               required=False,
+                               default=False)
+
 
 class Assignment(base.Assignment):
     """Portlet assignment.
@@ -34,8 +39,12 @@ class Assignment(base.Assignment):
 
     implements(IUpcomingPortlet)
 
-    def __init__(self, count=5):
+    # for assignments stored before the field existed
+    plone_events = False
+
+    def __init__(self, count=5, plone_events=False):
         self.count = count
+        self.plone_events = plone_events
 
     @property
     def title(self):
@@ -57,10 +66,14 @@ class Renderer(base.Renderer):
 
     def __init__(self, *args):
         base.Renderer.__init__(self, *args)
-        self.eventquery = getMultiAdapter((self.context, self.request), name=u'eventquery_view')
+        self.events = getMultiAdapter((self.context, self.request), name=u'combined-events')
 
     def eventDayList(self):
-        return self.eventquery.eventDayList(max=self.data.count)
+        if self.data.plone_events:
+            sources = None
+        else:
+            sources = ('sql', )
+        return self.events.eventDayList(max=self.data.count, sources=sources)
 
 
 class AddForm(base.AddForm):
@@ -75,7 +88,8 @@ class AddForm(base.AddForm):
     description = _(u"This portlet lists upcoming Events.")
 
     def create(self, data):
-        return Assignment(count=data.get('count', 5))
+        return Assignment(count=data.get('count', 5),
+                          plone_events=data.get('plone_events', False))
 
 
 class EditForm(base.EditForm):
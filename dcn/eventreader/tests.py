@@ -1,15 +1,48 @@
+import doctest
+import os
+import shutil
+import tempfile
 import unittest
+from datetime import date
 
 #from zope.testing import doctestunit
 #from zope.component import testing
 from Testing import ZopeTestCase as ztc
 
+from App.config import getConfiguration
+import transaction
+from zope.interface import implements
+
+from plone.app.layout.navigation.interfaces import INavigationRoot
+
 from Products.Five import fiveconfigure
 from Products.PloneTestCase import PloneTestCase as ptc
 from Products.PloneTestCase.layer import PloneSite
 ptc.setupPloneSite()
 
 import dcn.eventreader
+from dcn.eventreader.browser import cache
+from dcn.eventreader.browser import sqlitedb
+from dcn.eventreader.browser.dbaccess import EventConflictError
+from dcn.eventreader.browser.eventqueryview import EventQueryView
+
+
+# modules with doctests
+doctest_modules = (
+    'caldate',
+    'cache',
+    'directory',
+    'records',
+    'formatting',
+    'param_utils',
+    'timing',
+    'replicas',
+    'dbaccess',
+    'sqlitedb',
+    'eventsource',
+    'ical',
+    'jsonview',
+    )
 
 
 class TestCase(ptc.PloneTestCase):
@@ -27,6 +60,205 @@ class TestCase(ptc.PloneTestCase):
             pass
 
 
+class NavRoot(object):
+    """ a nav root for one organization """
+
+    implements(INavigationRoot)
+
+    def __init__(self, oid):
+        self.dbOrgId = oid
+
+
+class RangeView(object):
+    """ what EventQueryView.iterEvents needs, over a provider """
+
+    iterEvents = EventQueryView.iterEvents.im_func
+
+    def __init__(self, database, org_list):
+        self.database = database
+        self.org_list = org_list
+
+    def eventsByDateRange(self, start, end):
+        return self.database.eventsByDateRange(start, end, self.org_list)
+
+
+class SQLiteProviderTests(unittest.TestCase):
+    """
+        The event write path, against the SQLite stand-in
+        in a scratch file
+    """
+
+    dates = [(date(2012, 6, 1), date(2012, 6, 30), 'weekly')]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = getConfiguration()
+        self.product_config = getattr(self.config, 'product_config', None)
+        self.settings = {
+            'sqlite-file': os.path.join(self.tmpdir, 'eventreader.sqlite'),
+            }
+        self.config.product_config = {'dcn.eventreader': self.settings}
+        cache.clearAll()
+        context = NavRoot(1)
+        self.reader = sqlitedb.SQLiteEventDatabaseProvider(context)
+        self.writer = sqlitedb.SQLiteEventDatabaseWriteProvider(context)
+        self.writer.reader.query(
+            "INSERT INTO Orgs (oid, name, acronym) VALUES (1, 'Arts Council', 'AC')")
+
+    def tearDown(self):
+        transaction.abort()
+        cache.clearAll()
+        self.config.product_config = self.product_config
+        shutil.rmtree(self.tmpdir)
+
+    def save(self, eid=0, gcids=(1, 2), dates=None, version=None, **kwa):
+        if dates is None:
+            dates = self.dates
+        kwa.setdefault('title', u'Concert')
+        return self.writer.saveEvent(
+            eid, 'editor', gcids, dates, version=version, **kwa)
+
+    def record(self):
+        """ list of the SQL the writer runs from now on """
+
+        statements = []
+        query = self.writer._query
+
+        def recording(sql):
+            statements.append(sql)
+            return query(sql)
+
+        self.writer._query = recording
+        return statements
+
+    def writes(self, statements, table):
+        return [
+            s for s in '\0'.join(statements).split('\0')
+            if table in s and ('INSERT' in s or 'DELETE' in s)
+            ]
+
+    def occurrences(self, eid):
+        return sorted(self.writer.reader.query(
+            "SELECT date FROM EvOccurrences WHERE eid = %i" % eid)[1])
+
+    def testInsert(self):
+        eid = self.save()
+        self.assertEqual(self.reader.getEvent(eid)['title'], u'Concert')
+        self.assertEqual(
+            self.writer._storedSchedule(eid),
+            (set([1, 2]), set([('2012-06-01', '2012-06-30', 'weekly')])),
+            )
+
+    def testUnchangedSaveWritesNoSchedule(self):
+        eid = self.save()
+        statements = self.record()
+        self.save(eid, title=u'Recital')
+        self.assertEqual(self.writes(statements, 'EvCats'), [])
+        self.assertEqual(self.writes(statements, 'EvDates'), [])
+        self.assertEqual(self.reader.getEvent(eid)['title'], u'Recital')
+
+    def testSaveWritesDifferences(self):
+        eid = self.save()
+        statements = self.record()
+        dates = self.dates + [(date(2012, 7, 4), date(2012, 7, 4), 'daily')]
+        self.save(eid, gcids=[2, 3], dates=dates)
+        cats = self.writes(statements, 'EvCats')
+        self.assertEqual(len(cats), 2)
+        self.failUnless('gcid IN (1)' in cats[0])
+        self.failUnless('(%i, 3)' % eid in cats[1])
+        evdates = self.writes(statements, 'EvDates')
+        self.assertEqual(len(evdates), 1)
+        self.failUnless('2012-07-04' in evdates[0])
+        self.failIf('2012-06-01' in evdates[0])
+        self.assertEqual(
+            self.writer._storedSchedule(eid),
+            (set([2, 3]), set([
+                ('2012-06-01', '2012-06-30', 'weekly'),
+                ('2012-07-04', '2012-07-04', 'daily'),
+                ])),
+            )
+
+    def testRangeQuerySeesSave(self):
+        eid = self.save()
+        rows = self.reader.eventsByDateRange(
+            date(2012, 6, 1), date(2012, 6, 30), [1])
+        self.assertEqual([r['title'] for r in rows], [u'Concert'])
+        self.save(eid, title=u'Recital')
+        rows = self.reader.eventsByDateRange(
+            date(2012, 6, 1), date(2012, 6, 30), [1])
+        self.assertEqual([r['title'] for r in rows], [u'Recital'])
+
+    def testVersionedSave(self):
+        eid = self.save()
+        version = self.reader.getEvent(eid)['version']
+        self.save(eid, version=version, title=u'Recital')
+        self.assertEqual(self.reader.getEvent(eid)['title'], u'Recital')
+        # saves in the same second still move the version on
+        self.assertNotEqual(self.reader.getEvent(eid)['version'], version)
+
+    def testConflict(self):
+        eid = self.save()
+        version = self.reader.getEvent(eid)['version']
+        self.save(eid, version=version, title=u'Recital')
+        self.assertRaises(
+            EventConflictError,
+            self.save, eid, gcids=[5], version=version, title=u'Lecture',
+            )
+        # nothing of the stale save was written
+        self.assertEqual(self.reader.getEvent(eid)['title'], u'Recital')
+        self.assertEqual(self.writer._storedSchedule(eid)[0], set([1, 2]))
+
+    def testIterEventsWithNullTime(self):
+        timed = self.save(startTime='19:30')
+        untimed = self.save(title=u'Fair')
+        self.writer.reader.query(
+            "UPDATE Events SET startTime = NULL WHERE eid = %i" % untimed)
+        view = RangeView(self.reader, [1])
+        days = view.iterEvents(date(2012, 6, 1), date(2012, 6, 8))
+        self.assertEqual(
+            [(day.day, event['eid']) for day, event in days],
+            [(1, untimed), (1, timed), (8, untimed), (8, timed)],
+            )
+
+    def testShardedRangeMatches(self):
+        for oid in range(2, 8):
+            self.writer.reader.query(
+                "INSERT INTO Orgs (oid, name) VALUES (%i, 'Org %i')" % (oid, oid))
+        for oid in range(1, 8):
+            # same days everywhere, so shards tie on start
+            writer = sqlitedb.SQLiteEventDatabaseWriteProvider(NavRoot(oid))
+            writer.saveEvent(0, 'editor', [], self.dates,
+                title=u'Dance %i' % oid, startTime='19:30')
+            eid = writer.saveEvent(0, 'editor', [], self.dates,
+                title=u'Fair %i' % oid)
+            if oid % 2:
+                writer.reader.query(
+                    "UPDATE Events SET startTime = NULL WHERE eid = %i" % eid)
+        oids = range(1, 8)
+        start, end = date(2012, 6, 1), date(2012, 6, 30)
+        cache.clearAll()
+        whole = self.reader.eventsByDateRange(start, end, oids)
+        self.settings['shard-size'] = '2'
+        cache.clearAll()
+        sharded = self.reader.eventsByDateRange(start, end, oids)
+        self.assertEqual(len(whole), 14)
+        self.assertEqual(
+            [(r['eid'], r['start']) for r in sharded],
+            [(r['eid'], r['start']) for r in whole],
+            )
+
+    def testOccurrenceTable(self):
+        self.settings['use-occurrence-table'] = 'on'
+        eid = self.save()
+        self.assertEqual(len(self.occurrences(eid)), 5)
+        dates = [(date(2012, 6, 7), date(2012, 6, 30), 'biweekly')]
+        self.save(eid, dates=dates)
+        saved = self.occurrences(eid)
+        self.assertEqual(saved, [('2012-06-07', ), ('2012-06-21', )])
+        self.writer.rebuildOccurrences()
+        self.assertEqual(self.occurrences(eid), saved)
+
+
 def test_suite():
     return unittest.TestSuite([
 
@@ -35,10 +267,12 @@ def test_suite():
         #    'README.txt', package='dcn.eventreader',
         #    setUp=testing.setUp, tearDown=testing.tearDown),
 
-        #doctestunit.DocTestSuite(
-        #    module='dcn.eventreader.mymodule',
-        #    setUp=testing.setUp, tearDown=testing.tearDown),
+        ] + [
+        doctest.DocTestSuite('dcn.eventreader.browser.%s' % name)
+        for name in doctest_modules
+        ] + [
 
+        unittest.makeSuite(SQLiteProviderTests),
 
         # Integration tests that use PloneTestCase
         #ztc.ZopeDocFileSuite(